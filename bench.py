@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Micro-benchmarks on synthetic data.
+
+Usage: python3 -m fs2json.bench <benchmark> [options]
+"""
+import argparse
+import os
+import shlex
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from fs2json import fs2json
+import numpy as np
+from fs2json.dac import DacEngine, READ
+from fs2json.db import DatabaseCreator, DatabaseRead, DatabaseReadPool
+from fs2json.fs2json import scan_directory, open_output
+
+
+def make_tree(root: str, depth: int, dirs: int, files: int) -> int:
+    """Create a synthetic tree under `root`.
+
+    Every directory up to `depth` levels contains `dirs` subdirectories and
+    `files` empty regular files.
+
+    :returns: number of created entries.
+    """
+    count = 0
+    for i in range(files):
+        with open(os.path.join(root, f'file{i}'), 'w'):
+            pass
+        count += 1
+    if depth == 0:
+        return count
+    for i in range(dirs):
+        path = os.path.join(root, f'dir{i}')
+        os.mkdir(path)
+        count += 1 + make_tree(path, depth - 1, dirs, files)
+    return count
+
+
+def _walk_listdir(top: str) -> int:
+    count = 0
+    for f in os.listdir(top):
+        pathname = os.path.join(top, f)
+        try:
+            s = os.stat(pathname, follow_symlinks=False)
+        except (FileNotFoundError, PermissionError):
+            continue
+        count += 1
+        if stat.S_ISDIR(s.st_mode):
+            count += _walk_listdir(pathname)
+    return count
+
+
+def _walk_scandir(top: str) -> int:
+    count = 0
+    for f, pathname, s in scan_directory(top):
+        count += 1
+        if stat.S_ISDIR(s.st_mode):
+            count += _walk_scandir(pathname)
+    return count
+
+
+def _best_of(repeat: int, func, *args) -> float:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_walk(args) -> None:
+    """Compare `os.listdir` + `os.stat` walking with `scan_directory`."""
+    with tempfile.TemporaryDirectory() as root:
+        n = make_tree(root, args.depth, args.dirs, args.files)
+        listdir = _best_of(args.repeat, _walk_listdir, root)
+        scandir = _best_of(args.repeat, _walk_scandir, root)
+    print(f'entries={n}')
+    print(f'listdir+stat: {listdir:.3f}s ({n / listdir:.0f} entries/s)')
+    print(f'scandir:      {scandir:.3f}s ({n / scandir:.0f} entries/s)')
+    print(f'speedup:      {listdir / scandir:.2f}x')
+
+
+def _json_pipeline(root: str, output: str, level: int):
+    script = shlex.quote(fs2json.__file__)
+    subprocess.run(
+        f'{shlex.quote(sys.executable)} {script} {shlex.quote(root)} | '
+        f'zstd -q -f -T0 --long -{level} -o {shlex.quote(output)}',
+        shell=True,
+        check=True,
+    )
+
+
+def _json_in_process(root: str, output: str, level: int):
+    with open_output(output, 'zstd', level) as out:
+        fs2json.walktree(root, out)
+
+
+def bench_json(args) -> None:
+    """Compare `fs2json.sh` pipeline with in-process compression."""
+    with tempfile.TemporaryDirectory() as root:
+        n = make_tree(root, args.depth, args.dirs, args.files)
+        output = os.path.join(root, 'out.json.zst')
+        pipeline = _best_of(
+            args.repeat, _json_pipeline, root, output, args.level
+        )
+        in_process = _best_of(
+            args.repeat, _json_in_process, root, output, args.level
+        )
+    print(f'entries={n} level={args.level}')
+    print(f'print | zstd:   {pipeline:.3f}s ({n / pipeline:.0f} entries/s)')
+    print(f'in-process:     {in_process:.3f}s ({n / in_process:.0f} entries/s)')
+    print(f'speedup:        {pipeline / in_process:.2f}x')
+
+
+def make_database(
+    path: str, depth: int, dirs: int, files: int, types: int = 16
+) -> int:
+    """Create a database of a synthetic tree shaped like `make_tree` without
+    touching the file system.
+
+    Dentries get one of `types` SELinux types, one of 8 owners, one of 4
+    groups and various modes in a round-robin fashion.
+
+    :returns: number of created entries.
+    """
+    db = DatabaseCreator(path, drop=True)
+    root = db.insert_dentry(
+        None, '', 1, 1, 1, 0, 0, 0, 0.0, 0.0, 0.0, stat.S_IFDIR, 0o755, None, ''
+    )
+    count = 1
+    frontier = [(root, '', depth)]
+    while frontier:
+        parent, parent_path, level = frontier.pop()
+        children = [(f'file{i}', stat.S_IFREG) for i in range(files)]
+        if level:
+            children += [(f'dir{i}', stat.S_IFDIR) for i in range(dirs)]
+        for name, _type in children:
+            count += 1
+            context = f'system_u:object_r:type{count % types}_t:s0'
+            child_path = f'{parent_path}/{name}'
+            rowid = db.insert_dentry(
+                parent, name, count, 1, 1, count % 8, count % 4, 0, 0.0, 0.0,
+                0.0, _type, count * 0o123 & 0o777, context, child_path,
+            )
+            if _type == stat.S_IFDIR:
+                frontier.append((rowid, child_path, level - 1))
+    db.number_tree()
+    db.close()
+    return count
+
+
+# Query used before the path column existed, kept for comparison
+_RECURSIVE_PATHS = '''WITH RECURSIVE child AS
+(
+  SELECT rowid AS original, rowid, parent, name, type
+  FROM fs
+  WHERE context_id IN (SELECT rowid FROM object_contexts
+                       WHERE type IN ({}))
+
+  UNION ALL
+
+  SELECT original, fs.rowid, fs.parent, fs.name || '/' || child.name, child.type
+  FROM fs, child
+  WHERE child.parent = fs.rowid
+)
+SELECT original, name, type
+From child
+WHERE rowid = 1'''
+_COLUMN_PATHS = '''SELECT rowid, path, type
+FROM fs
+WHERE context_id IN (SELECT rowid FROM object_contexts
+                     WHERE type IN ({}))'''
+
+
+def _query_paths(db: DatabaseCreator, query: str, types: tuple) -> list:
+    return db.cur.execute(
+        query.format(', '.join('?' * len(types))), types
+    ).fetchall()
+
+
+def _dac_per_inode(db: DatabaseRead, uid: int, rowids: list[int]) -> int:
+    return sum(db.can_read(db.get_inode(rowid), uid) for rowid in rowids)
+
+
+def _dac_effective_per_inode(
+    db: DatabaseRead, uid: int, rowids: list[int]
+) -> int:
+    count = 0
+    for rowid in rowids:
+        inode = db.get_inode(rowid)
+        allowed = db.can_read(inode, uid)
+        while allowed and inode.parent is not None:
+            inode = db.get_inode(inode.parent)
+            allowed = db.can_execute(inode, uid)
+        count += allowed
+    return count
+
+
+def bench_dac(args) -> None:
+    """Compare `DatabaseRead.can_read` per inode with `DacEngine`."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fs.db')
+        n = make_database(path, args.depth, args.dirs, args.files)
+        db = DatabaseCreator(path)
+        # uid 1 is in its main group 1 and in supplementary group 2
+        db.cur.executemany(
+            'INSERT INTO users VALUES(?, ?, ?)',
+            ((f'user{i}', i, i % 4) for i in range(8)),
+        )
+        db.cur.execute('INSERT INTO membership VALUES(1, 2)')
+        db.close()
+
+        db = DatabaseRead(path)
+        sample = list(range(1, n + 1, max(1, n // args.sample)))
+        per_inode = _best_of(args.repeat, _dac_per_inode, db, 1, sample)
+        # Whole table is loaded once, then every query is a vectorized pass
+        start = perf_counter()
+        engine = DacEngine(db)
+        load = perf_counter() - start
+        vectorized = _best_of(args.repeat, engine.count, 1, READ)
+        effective_per_inode = _best_of(
+            args.repeat, _dac_effective_per_inode, db, 1, sample
+        )
+        effective = _best_of(args.repeat, engine.effective, 1, READ)
+        index = np.searchsorted(engine.rowid, sample)
+        if int(
+            np.count_nonzero(engine.can_read(1)[index])
+        ) != _dac_per_inode(db, 1, sample) or int(
+            np.count_nonzero(engine.effective(1, READ)[index])
+        ) != _dac_effective_per_inode(db, 1, sample):
+            sys.exit('DacEngine differs from DatabaseRead.can_read')
+        db.close()
+    per_row = per_inode / len(sample) * n
+    effective_per_row = effective_per_inode / len(sample) * n
+    print(f'entries={n} sample={len(sample)}')
+    print(f'DacEngine load:               {load:.3f}s')
+    print(f'can_read per inode:           {per_row:.3f}s (extrapolated)')
+    print(f'DacEngine can_read:           {vectorized:.3f}s')
+    print(f'speedup:                      {per_row / vectorized:.0f}x')
+    print(
+        f'can_read with ancestors:      {effective_per_row:.3f}s (extrapolated)'
+    )
+    print(f'DacEngine effective read:     {effective:.3f}s')
+    print(f'speedup:                      {effective_per_row / effective:.0f}x')
+
+
+def bench_paths(args) -> None:
+    """Compare paths rebuilt by a recursive CTE with the path column."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fs.db')
+        n = make_database(path, args.depth, args.dirs, args.files)
+        db = DatabaseCreator(path)
+        types = tuple(f'type{i}_t' for i in range(args.types))
+        recursive = _best_of(
+            args.repeat, _query_paths, db, _RECURSIVE_PATHS, types
+        )
+        column = _best_of(args.repeat, _query_paths, db, _COLUMN_PATHS, types)
+        rows = _query_paths(db, _COLUMN_PATHS, types)
+        if sorted(rows) != sorted(
+            _query_paths(db, _RECURSIVE_PATHS, types)
+        ):
+            sys.exit('path column differs from the recursive query')
+        db.close(indexes=False)
+    print(f'entries={n} rows={len(rows)}')
+    print(f'recursive CTE: {recursive:.3f}s ({len(rows) / recursive:.0f} rows/s)')
+    print(f'path column:   {column:.3f}s ({len(rows) / column:.0f} rows/s)')
+    print(f'speedup:       {recursive / column:.2f}x')
+
+
+def _count_subtree_queries(
+    run, paths: list[str], threads: int, selinux_types: tuple
+) -> list[int]:
+    with ThreadPoolExecutor(threads) as executor:
+        return list(
+            executor.map(
+                lambda path: run(
+                    DatabaseRead.count_subtree,
+                    path,
+                    selinux_types=selinux_types,
+                ),
+                paths,
+            )
+        )
+
+
+def bench_pool(args) -> None:
+    """Compare a shared connection with `DatabaseReadPool` by thread count."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fs.db')
+        n = make_database(path, args.depth, args.dirs, args.files)
+        # Directories two levels deep, queried round-robin
+        paths = [
+            f'/dir{i}/dir{j}'
+            for i in range(args.dirs)
+            for j in range(args.dirs)
+        ]
+        paths = (paths * (args.queries // len(paths) + 1))[: args.queries]
+        selinux_types = ('type1_t', 'type2_t')
+
+        # Status quo, threads take turns on a single connection
+        shared = DatabaseRead(path, readonly=True)
+        lock = threading.Lock()
+
+        def run_shared(func, *a, **kw):
+            with lock:
+                return func(shared, *a, **kw)
+
+        expected = _count_subtree_queries(run_shared, paths, 1, selinux_types)
+        print(f'entries={n} queries={len(paths)}')
+        print('threads  shared (queries/s)  pool (queries/s)')
+        for threads in args.threads:
+            elapsed = _best_of(
+                args.repeat,
+                _count_subtree_queries,
+                run_shared,
+                paths,
+                threads,
+                selinux_types,
+            )
+            with DatabaseReadPool(
+                path, threads, immutable=args.immutable
+            ) as pool:
+                if (
+                    _count_subtree_queries(
+                        pool.run, paths, threads, selinux_types
+                    )
+                    != expected
+                ):
+                    sys.exit('DatabaseReadPool differs from DatabaseRead')
+                pooled = _best_of(
+                    args.repeat,
+                    _count_subtree_queries,
+                    pool.run,
+                    paths,
+                    threads,
+                    selinux_types,
+                )
+            print(
+                f'{threads:7}  {len(paths) / elapsed:18.0f}'
+                f'  {len(paths) / pooled:16.0f}'
+            )
+        shared.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    walk = sub.add_parser('walk', help=bench_walk.__doc__)
+    walk.add_argument('--depth', type=int, default=3)
+    walk.add_argument('--dirs', type=int, default=10)
+    walk.add_argument('--files', type=int, default=50)
+    walk.add_argument('--repeat', type=int, default=3)
+    walk.set_defaults(func=bench_walk)
+
+    json = sub.add_parser('json', help=bench_json.__doc__)
+    json.add_argument('--depth', type=int, default=3)
+    json.add_argument('--dirs', type=int, default=10)
+    json.add_argument('--files', type=int, default=50)
+    json.add_argument('--level', type=int, default=3)
+    json.add_argument('--repeat', type=int, default=3)
+    json.set_defaults(func=bench_json)
+
+    paths = sub.add_parser('paths', help=bench_paths.__doc__)
+    paths.add_argument('--depth', type=int, default=4)
+    paths.add_argument('--dirs', type=int, default=10)
+    paths.add_argument('--files', type=int, default=20)
+    paths.add_argument(
+        '--types', type=int, default=4, help='number of selected types of 16'
+    )
+    paths.add_argument('--repeat', type=int, default=3)
+    paths.set_defaults(func=bench_paths)
+
+    dac = sub.add_parser('dac', help=bench_dac.__doc__)
+    dac.add_argument('--depth', type=int, default=4)
+    dac.add_argument('--dirs', type=int, default=10)
+    dac.add_argument('--files', type=int, default=20)
+    dac.add_argument(
+        '--sample', type=int, default=10000, help='inodes checked one by one'
+    )
+    dac.add_argument('--repeat', type=int, default=3)
+    dac.set_defaults(func=bench_dac)
+
+    pool = sub.add_parser('pool', help=bench_pool.__doc__)
+    pool.add_argument('--depth', type=int, default=4)
+    pool.add_argument('--dirs', type=int, default=10)
+    pool.add_argument('--files', type=int, default=20)
+    pool.add_argument('--queries', type=int, default=2000)
+    pool.add_argument(
+        '--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16]
+    )
+    pool.add_argument(
+        '--immutable', action='store_true', help='open pool with immutable=1'
+    )
+    pool.add_argument('--repeat', type=int, default=3)
+    pool.set_defaults(func=bench_pool)
+
+    args = parser.parse_args()
+    args.func(args)
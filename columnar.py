@@ -0,0 +1,329 @@
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Columnar snapshot of the fs table that can be memory-mapped.
+
+`export_columnar` writes a directory with one `.npy` file per column, the
+names of all dentries concatenated in `names.bin` and `meta.json`. Dentries
+are stored in breadth-first order with children of every directory sorted by
+name, so the children of dentry `i` are the dentries
+`child_offsets[i]` to `child_offsets[i + 1] - 1`. `FsIndex` maps the files
+and navigates the tree without SQLite.
+
+Usage: python3 -m fs2json.columnar <database> <directory>
+"""
+import argparse
+import json
+import mmap
+import os
+import stat
+from collections.abc import Iterator
+import numpy as np
+from .db import DatabaseCommon, DatabaseRead, Inode
+
+FORMAT_VERSION = 1
+# Columns of the fs table and their types in the exported arrays
+COLUMNS = {
+    'rowid': np.int64,
+    'ino': np.int64,
+    'dev': np.int64,
+    'nlink': np.uint32,
+    'uid': np.uint32,
+    'gid': np.uint32,
+    'size': np.int64,
+    'atime': np.float64,
+    'mtime': np.float64,
+    'ctime': np.float64,
+    'type': np.uint16,
+    'mode': np.uint16,
+    'context_id': np.int64,
+}
+
+
+def _expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Return concatenation of `range(start, start + count)` of all pairs."""
+    # Offset of every element within its range
+    within = np.arange(int(counts.sum())) - np.repeat(
+        np.cumsum(counts) - counts, counts
+    )
+    return np.repeat(starts, counts) + within
+
+
+def export_columnar(
+    db: DatabaseCommon, directory: str, chunk_size: int = 1 << 14
+) -> int:
+    """Write the fs table of `db` to `directory` in the columnar format.
+
+    Dentries that aren't reachable from a dentry without a parent are left
+    out. The table is read twice, first only to compute the order of the
+    dentries. Columns are then written straight to memory-mapped files, so
+    only a few integers per dentry are kept in memory.
+
+    :param chunk_size: number of rows fetched from the database at once.
+    :returns: number of exported dentries.
+    """
+    # Both passes have to see the same rows
+    db.cur.execute('SAVEPOINT export_columnar')
+    try:
+        return _export_columnar(db, directory, chunk_size)
+    finally:
+        db.cur.execute('RELEASE export_columnar')
+
+
+def _export_columnar(
+    db: DatabaseCommon, directory: str, chunk_size: int
+) -> int:
+    rows = db.con.execute('SELECT COUNT(*) FROM fs').fetchone()[0]
+    # Grouped by parent and sorted by name through parent_name_index, in the
+    # same byte order as names are compared by `FsIndex`
+    order_by = 'ORDER BY parent, name'
+    parents = np.empty(rows, np.int64)
+    rowids = np.empty(rows, np.int64)
+    name_lengths = np.empty(rows, np.int64)
+    res = db.con.execute(
+        f'SELECT IFNULL(parent, 0), rowid, name FROM fs {order_by}'
+    )
+    i = 0
+    while chunk := res.fetchmany(chunk_size):
+        end = i + len(chunk)
+        parents[i:end] = [row[0] for row in chunk]
+        rowids[i:end] = [row[1] for row in chunk]
+        name_lengths[i:end] = [
+            len(row[2].encode('utf-8', 'surrogateescape')) for row in chunk
+        ]
+        i = end
+
+    # Breadth-first order as positions in the sorted rows, level by level
+    roots = np.flatnonzero(parents == 0)
+    roots = roots[np.argsort(rowids[roots], kind='stable')]
+    levels = [roots]
+    counts = []
+    level = roots
+    while len(level):
+        starts = np.searchsorted(parents, rowids[level], 'left')
+        level_counts = np.searchsorted(parents, rowids[level], 'right') - starts
+        counts.append(level_counts)
+        level = _expand_ranges(starts, level_counts)
+        levels.append(level)
+    del parents, rowids
+    order = np.concatenate(levels)
+    counts = np.concatenate(counts) if counts else np.empty(0, np.int64)
+    n = len(order)
+    # Position of every sorted row in the breadth-first order
+    positions = np.full(rows, -1, np.int64)
+    positions[order] = np.arange(n)
+
+    os.makedirs(directory, exist_ok=True)
+    child_offsets = np.concatenate(([0], np.cumsum(counts))) + len(roots)
+    np.save(os.path.join(directory, 'child_offsets.npy'), child_offsets)
+    parent = np.full(n, -1, np.int64)
+    parent[len(roots):] = np.repeat(np.arange(n, dtype=np.int64), counts)
+    np.save(os.path.join(directory, 'parent.npy'), parent)
+    del child_offsets, parent, counts
+    name_offsets = np.zeros(n + 1, np.int64)
+    np.cumsum(name_lengths[order], out=name_offsets[1:])
+    np.save(os.path.join(directory, 'name_offsets.npy'), name_offsets)
+    del name_lengths, order
+
+    columns = {
+        column: np.lib.format.open_memmap(
+            os.path.join(directory, f'{column}.npy'), 'w+', dtype, (n,)
+        )
+        for column, dtype in COLUMNS.items()
+    }
+    offsets = _view(name_offsets)
+    select = ', '.join(COLUMNS).replace(
+        'context_id', 'IFNULL(context_id, -1)'
+    )
+    res = db.con.execute(f'SELECT name, {select} FROM fs {order_by}')
+    with open(os.path.join(directory, 'names.bin'), 'w+b') as f:
+        f.truncate(offsets[n])
+        # Empty file can't be mapped
+        names = mmap.mmap(f.fileno(), 0) if offsets[n] else None
+        i = 0
+        while chunk := res.fetchmany(chunk_size):
+            end = i + len(chunk)
+            chunk_positions = positions[i:end]
+            exported = chunk_positions >= 0
+            chunk_positions = chunk_positions[exported]
+            for k, (column, values) in enumerate(columns.items(), 1):
+                values[chunk_positions] = np.fromiter(
+                    (row[k] for row in chunk), COLUMNS[column], len(chunk)
+                )[exported]
+            for position, row in zip(positions[i:end].tolist(), chunk):
+                if position >= 0:
+                    name = row[0].encode('utf-8', 'surrogateescape')
+                    names[offsets[position] : offsets[position + 1]] = name
+            i = end
+        if names is not None:
+            names.close()
+    for values in columns.values():
+        values.flush()
+    del columns
+
+    contexts = db.con.execute(
+        '''SELECT rowid, user, role, type, sensitivity, category
+           FROM object_contexts'''
+    ).fetchall()
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(
+            {
+                'version': FORMAT_VERSION,
+                'count': n,
+                'roots': len(roots),
+                'contexts': contexts,
+            },
+            f,
+        )
+    return n
+
+
+def _view(array: np.ndarray) -> memoryview:
+    """Return memoryview of a mapped array in the native byte order."""
+    return memoryview(array).cast('B').cast(array.dtype.char)
+
+
+class FsIndex:
+    """Read-only view of a snapshot written by `export_columnar`.
+
+    Columns are memory-mapped NumPy arrays indexed by the position of a
+    dentry, e.g. `index.uid[i]`, so opening the index reads almost nothing.
+    Listing children is a slice of positions, resolving a path is a binary
+    search among the children of every directory on the way.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError(
+                f"unsupported columnar format version {meta['version']}"
+            )
+        self.roots = meta['roots']
+        self._contexts = {
+            rowid: tuple(context) for rowid, *context in meta['contexts']
+        }
+        for column in (*COLUMNS, 'parent', 'child_offsets', 'name_offsets'):
+            setattr(
+                self,
+                column,
+                np.load(os.path.join(directory, f'{column}.npy'), 'r'),
+            )
+        # Indexing a memoryview returns a Python int, which is much cheaper
+        # than a NumPy scalar in the navigation loops
+        self._child_offsets = _view(self.child_offsets)
+        self._name_offsets = _view(self.name_offsets)
+        self._parent = _view(self.parent)
+        self._type = _view(self.type)
+        with open(os.path.join(directory, 'names.bin'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._names = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty file can't be mapped
+                self._names = b''
+
+    def __len__(self) -> int:
+        return len(self.rowid)
+
+    def _name(self, i: int) -> bytes:
+        return self._names[self._name_offsets[i] : self._name_offsets[i + 1]]
+
+    def name(self, i: int) -> str:
+        return self._name(i).decode('utf-8', 'surrogateescape')
+
+    def children(self, i: int) -> range:
+        """Return positions of dentries inside directory `i`."""
+        return range(self._child_offsets[i], self._child_offsets[i + 1])
+
+    def child(self, i: int, name: str) -> int | None:
+        """Return position of the dentry `name` inside directory `i`."""
+        name = name.encode('utf-8', 'surrogateescape')
+        lo, end = self._child_offsets[i], self._child_offsets[i + 1]
+        hi = end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end and self._name(lo) == name:
+            return lo
+        return None
+
+    def lookup(self, path: str) -> int | None:
+        """Return position of the dentry at `path` below the first root, as
+        `DatabaseCommon.get_rowid` does for rowid 1."""
+        i = 0 if len(self) else None
+        for component in filter(None, path.split('/')):
+            if i is None or self._type[i] != stat.S_IFDIR:
+                return None
+            i = self.child(i, component)
+        return i
+
+    def path(self, i: int) -> str:
+        """Return path of dentry `i` as stored in the path column."""
+        names = []
+        while i >= 0:
+            names.append(self.name(i))
+            i = self._parent[i]
+        return '/'.join(reversed(names))
+
+    def inode(self, i: int) -> Inode:
+        """Return metadata of dentry `i` as `DatabaseCommon.get_inode`."""
+        parent = int(self.parent[i])
+        return Inode(
+            int(self.rowid[parent]) if parent >= 0 else None,
+            self.name(i),
+            int(self.ino[i]),
+            int(self.dev[i]),
+            int(self.nlink[i]),
+            int(self.uid[i]),
+            int(self.gid[i]),
+            int(self.size[i]),
+            float(self.atime[i]),
+            float(self.mtime[i]),
+            float(self.ctime[i]),
+            int(self.type[i]),
+            int(self.mode[i]),
+            *self._contexts.get(int(self.context_id[i]), (None,) * 5),
+        )
+
+    def walk(self, i: int = 0) -> Iterator[int]:
+        """Yield positions of the subtree of `i` in depth-first order."""
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            yield i
+            stack.extend(reversed(self.children(i)))
+
+    def close(self):
+        if isinstance(self._names, mmap.mmap):
+            self._names.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='path of the database file')
+    parser.add_argument('directory', help='output directory')
+    args = parser.parse_args()
+    db = DatabaseRead(args.database)
+    n = export_columnar(db, args.directory)
+    db.close()
+    print(f'exported {n} dentries')
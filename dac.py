@@ -0,0 +1,252 @@
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Vectorized evaluation of UNIX discretionary access control.
+
+`DacEngine` loads ownership and mode of every dentry once and answers
+questions like "what can uid X read" for the whole snapshot with NumPy
+instead of one `DatabaseRead.can_read` call per inode.
+
+Effective access additionally requires search (execute) permission on every
+ancestor directory. It can be stored as a bitmap per uid by
+`DacEngine.store_effective_access` and queried without loading the snapshot
+by `DatabaseCommon.has_effective_access` and `effective_rowids`.
+"""
+from collections.abc import Iterable
+import stat
+import numpy as np
+from .db import DatabaseCommon, DatabaseCreator
+
+# Permission bits of a single class (owner, group or others)
+READ = 4
+WRITE = 2
+EXECUTE = 1
+
+
+class DacEngine:
+    """Columns `rowid`, `uid`, `gid`, `mode` and `type` of the fs table as
+    NumPy arrays.
+
+    Permissions are evaluated in the same way as `DatabaseRead.can_read`: the
+    owner class applies to the owner, the group class to members of the file
+    group and the others class to everyone else. Root gets no special
+    treatment.
+
+    Depth-first numbers from `DatabaseCreator.number_tree` are loaded too,
+    so effective access can be computed without walking the tree.
+    """
+
+    def __init__(
+        self, db: DatabaseCommon, path: str = '/', chunk_size: int = 1 << 20
+    ):
+        """Load the snapshot or the subtree at `path` from `db`.
+
+        :param chunk_size: number of rows fetched from the database at once.
+        """
+        # Ownership and mode of directories above `path`
+        self._ancestors = []
+        if path.strip('/'):
+            rowid = db.get_rowid(path)
+            if rowid is None:
+                raise FileNotFoundError(path)
+            where = 'WHERE dfs_enter BETWEEN ? AND ?'
+            params = db.get_subtree_range(rowid)
+            parent = db.get_inode(rowid).parent
+            while parent is not None:
+                inode = db.get_inode(parent)
+                self._ancestors.append((inode.uid, inode.gid, inode.mode))
+                parent = inode.parent
+        else:
+            where = ''
+            params = ()
+        self.full = not self._ancestors
+        res = db.con.execute(
+            f'''SELECT rowid, uid, gid, mode, type, dfs_enter, dfs_exit
+                FROM fs {where}''',
+            params,
+        )
+        chunks = []
+        while rows := res.fetchmany(chunk_size):
+            try:
+                chunks.append(np.array(rows, dtype=np.int64))
+            except TypeError:
+                raise ValueError(
+                    'fs table is not numbered, see DatabaseCreator.number_tree'
+                ) from None
+        table = (
+            np.concatenate(chunks) if chunks else np.empty((0, 7), np.int64)
+        )
+        self.rowid = table[:, 0].copy()
+        self.uid = table[:, 1].copy()
+        self.gid = table[:, 2].copy()
+        self.mode = table[:, 3].astype(np.uint16)
+        self.type = table[:, 4].astype(np.uint32)
+        # Position of every row in the depth-first order of the loaded tree,
+        # stored numbers have gaps
+        numbers = np.sort(table[:, 5])
+        self._enter = np.searchsorted(numbers, table[:, 5])
+        # Exit of a deleted row maps to the last row left in the range
+        self._exit = np.searchsorted(numbers, table[:, 6], 'right') - 1
+        # rwx bits of each class, `mode` itself is not needed afterwards
+        self._owner_bits = (self.mode >> 6 & 7).astype(np.uint8)
+        self._group_bits = (self.mode >> 3 & 7).astype(np.uint8)
+        self._other_bits = (self.mode & 7).astype(np.uint8)
+        self._groups = self._load_membership(db)
+
+    @staticmethod
+    def _load_membership(db: DatabaseCommon) -> dict[int, np.ndarray]:
+        """Return array of group IDs of every user, including the main
+        group."""
+        groups = {}
+        for uid, gid in db.cur.execute('SELECT uid, gid FROM users'):
+            groups.setdefault(uid, []).append(gid)
+        for uid, gid in db.cur.execute('SELECT uid, gid FROM membership'):
+            groups.setdefault(uid, []).append(int(gid))
+        return {
+            uid: np.unique(np.array(gids, dtype=np.int64))
+            for uid, gids in groups.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.rowid)
+
+    def groups(self, uid: int) -> np.ndarray:
+        """Return group IDs of user `uid`, empty if the user is unknown."""
+        return self._groups.get(uid, np.empty(0, np.int64))
+
+    def permissions(self, uid: int) -> np.ndarray:
+        """Return rwx bits (`READ | WRITE | EXECUTE`) granted to `uid` for
+        every row."""
+        owner = self.uid == uid
+        group = np.isin(self.gid, self.groups(uid))
+        return np.where(
+            owner,
+            self._owner_bits,
+            np.where(group, self._group_bits, self._other_bits),
+        )
+
+    def permission_matrix(self, uids: Iterable[int]) -> np.ndarray:
+        """Return rwx bits of every row for each of `uids`.
+
+        :returns: array of shape `(len(uids), len(self))`.
+        """
+        uids = list(uids)
+        matrix = np.empty((len(uids), len(self)), dtype=np.uint8)
+        for i, uid in enumerate(uids):
+            matrix[i] = self.permissions(uid)
+        return matrix
+
+    def can(self, uid: int, permission: int) -> np.ndarray:
+        """Return boolean mask of rows where `uid` has all `permission`
+        bits."""
+        return (self.permissions(uid) & permission) == permission
+
+    def can_read(self, uid: int) -> np.ndarray:
+        return self.can(uid, READ)
+
+    def can_write(self, uid: int) -> np.ndarray:
+        return self.can(uid, WRITE)
+
+    def can_execute(self, uid: int) -> np.ndarray:
+        return self.can(uid, EXECUTE)
+
+    def rowids(self, mask: np.ndarray) -> np.ndarray:
+        """Return rowids of rows selected by `mask`."""
+        return self.rowid[mask]
+
+    def count(self, uid: int, permission: int) -> int:
+        """Return number of rows where `uid` has all `permission` bits."""
+        return int(np.count_nonzero(self.can(uid, permission)))
+
+    def _ancestors_searchable(self, uid: int) -> bool:
+        """Check if `uid` can search all directories above the loaded tree."""
+        groups = self.groups(uid)
+        for owner, group, mode in self._ancestors:
+            if owner == uid:
+                bits = mode >> 6 & 7
+            elif group in groups:
+                bits = mode >> 3 & 7
+            else:
+                bits = mode & 7
+            if not bits & EXECUTE:
+                return False
+        return True
+
+    def reachable(self, uid: int) -> np.ndarray:
+        """Return boolean mask of rows whose every ancestor directory can be
+        searched by `uid`.
+
+        Every directory that `uid` can't search blocks the interval of
+        depth-first positions of its descendants. Intervals are marked in a
+        difference array, so the whole tree is processed in a single pass.
+        """
+        if not self._ancestors_searchable(uid):
+            return np.zeros(len(self), dtype=bool)
+        blocking = (self.type == stat.S_IFDIR) & ~self.can_execute(uid)
+        n = len(self)
+        diff = np.bincount(
+            self._enter[blocking] + 1, minlength=n + 1
+        ) - np.bincount(self._exit[blocking] + 1, minlength=n + 1)
+        blocked = np.cumsum(diff[:n]) > 0
+        return ~blocked[self._enter]
+
+    def effective(self, uid: int, permission: int) -> np.ndarray:
+        """Return boolean mask of rows where `uid` has all `permission` bits
+        and can reach the dentry through searchable directories."""
+        return self.can(uid, permission) & self.reachable(uid)
+
+    def effective_bitmap(self, uid: int, permission: int) -> bytes:
+        """Return `effective` as a bitmap indexed by rowid.
+
+        Bit `rowid % 8` of byte `rowid // 8` is set if access is granted.
+        """
+        bits = np.zeros(int(self.rowid.max(initial=0)) + 1, dtype=bool)
+        bits[self.rowid[self.effective(uid, permission)]] = True
+        return np.packbits(bits, bitorder='little').tobytes()
+
+    def store_effective_access(
+        self,
+        db: DatabaseCreator,
+        uids: Iterable[int],
+        permissions: Iterable[int] = (READ, WRITE, EXECUTE),
+    ):
+        """Store effective access bitmaps of `uids` in `db`.
+
+        Bitmaps are discarded when the tree is renumbered after a change.
+        """
+        if not self.full:
+            raise ValueError('effective access can be stored only for /')
+        permissions = tuple(permissions)
+        for uid in uids:
+            for permission in permissions:
+                db.insert_effective_access(
+                    uid, permission, self.effective_bitmap(uid, permission)
+                )
+
+
+def effective_rowids(
+    db: DatabaseCommon, uid: int, permission: int
+) -> np.ndarray | None:
+    """Return rowids of dentries which `uid` can effectively access with all
+    `permission` bits, as stored by `DacEngine.store_effective_access`.
+
+    :returns: `None` if no bitmap is stored for `uid` and `permission`.
+    """
+    bitmap = db.get_effective_access(uid, permission)
+    if bitmap is None:
+        return None
+    bits = np.unpackbits(
+        np.frombuffer(bitmap, dtype=np.uint8), bitorder='little'
+    )
+    return np.flatnonzero(bits)
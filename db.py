@@ -14,26 +14,34 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """Filesystem database in sqlite format.
 
-Doesn't support updating, database has to be recreated everytime.
+The fs table can be brought up to date with `fs2sql.updatetree`, which only
+rescans directories that changed since the database was created.
 """
+import json
+import multiprocessing
+import queue
 import sqlite3
-from collections import namedtuple
+import threading
+from collections import namedtuple, OrderedDict
 import os
 import stat
-from collections.abc import Iterable
+from collections.abc import Iterable, Iterator
 from .helpers import (
     construct_selinux_context,
     selinux_check_access,
-    selinux_label_lookup,
+    selinux_label_lookup_many,
+    selinux_policy_hash,
 )
 
 if os.name == 'posix':
     import pwd
     import grp
-from itertools import chain
+from contextlib import contextmanager
+from itertools import chain, islice
 from pprint import pprint
 from pandas import read_sql_query
-from typing import TextIO
+from typing import Callable, TextIO
+from urllib.parse import quote
 from .evaluation import Result
 from pandas.core.api import DataFrame
 
@@ -61,28 +69,297 @@ Inode = namedtuple(
         'selinux_category',
     ],
 )
+# Columns of `Inode` as selected from the fs_view view
+INODE_COLUMNS = ', '.join(Inode._fields)
+
+# Row of the fs table
+Dentry = namedtuple(
+    'Dentry',
+    [
+        'rowid',
+        'parent',
+        'name',
+        'ino',
+        'dev',
+        'nlink',
+        'uid',
+        'gid',
+        'size',
+        'atime',
+        'mtime',
+        'ctime',
+        'type',
+        'mode',
+        'context_id',
+        'path',
+        'dfs_enter',
+        'dfs_exit',
+    ],
+)
+# Columns of the fs table without rowid
+FS_COLUMNS = ', '.join(Dentry._fields[1:])
+# Difference of consecutive depth-first numbers assigned by `number_tree`,
+# the gaps are filled by `number_new_dentries`
+DFS_SPACING = 16
+
+# Statistics of `PathCache` in the style of `functools.lru_cache`
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+# Statistics of `DecisionCache`
+DecisionCacheInfo = namedtuple(
+    'DecisionCacheInfo', ['hits', 'misses', 'loaded', 'currsize']
+)
+
+
+class DecisionCache:
+    """Cache of `selinux_check_access` results.
+
+    Decisions depend only on `(scontext, tcontext, tclass, perm)`, so every
+    distinct tuple is checked just once. Decisions are also stored in the
+    selinux_decisions table under the hash of the loaded policy, so they are
+    reused by later runs until the policy changes.
+    """
+
+    def __init__(
+        self,
+        cur: sqlite3.Cursor | None,
+        policy: str | None,
+        decisions: dict | None = None,
+    ):
+        """Load decisions stored for `policy`.
+
+        :param policy: hash of the loaded policy, the cache is kept only in
+        memory if `None`.
+        :param decisions: initial decisions, as returned by `decisions`.
+        """
+        self.cur = cur
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self._decisions = dict(decisions or {})
+        self._new = []
+        if policy is not None:
+            res = cur.execute(
+                '''SELECT scontext, tcontext, tclass, perm, result
+                   FROM selinux_decisions WHERE policy = ?''',
+                (policy,),
+            )
+            for *key, result in res:
+                self._decisions[tuple(key)] = result
+        self.loaded = len(self._decisions)
+
+    def check(self, scon: str, tcon: str, tclass: str, perm: str) -> int:
+        """Return cached result of `selinux_check_access`."""
+        key = (scon, tcon, tclass, perm)
+        result = self._decisions.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = selinux_check_access(scon, tcon, tclass, perm)
+        self._decisions[key] = result
+        self._new.append(key)
+        return result
+
+    def decisions(self) -> dict:
+        """Return all cached decisions keyed by `(scon, tcon, tclass,
+        perm)`."""
+        return dict(self._decisions)
+
+    def take_new(self) -> dict:
+        """Return decisions made since the last call and forget they are
+        new."""
+        new = {key: self._decisions[key] for key in self._new}
+        self._new = []
+        return new
+
+    def merge(self, decisions: dict, hits: int = 0, misses: int = 0):
+        """Add decisions and statistics of another cache, e.g. in a worker
+        process."""
+        for key, result in decisions.items():
+            if key not in self._decisions:
+                self._decisions[key] = result
+                self._new.append(key)
+        self.hits += hits
+        self.misses += misses
+
+    def flush(self):
+        """Store decisions made since the last flush in the database."""
+        if self.policy is not None and self._new:
+            self.cur.executemany(
+                '''INSERT INTO selinux_decisions VALUES(?, ?, ?, ?, ?, ?)
+                   ON CONFLICT DO NOTHING''',
+                (
+                    (self.policy, *key, self._decisions[key])
+                    for key in self._new
+                ),
+            )
+        self._new = []
+
+    def info(self) -> DecisionCacheInfo:
+        return DecisionCacheInfo(
+            self.hits, self.misses, self.loaded, len(self._decisions)
+        )
+
+
+class PathCache:
+    """Bounded LRU cache of directory rowids keyed by path components."""
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._rowids = OrderedDict()
+
+    def get(self, components: tuple[str, ...]) -> int | None:
+        """Return cached rowid of the directory, `None` if it isn't cached."""
+        rowid = self._rowids.get(components)
+        if rowid is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rowids.move_to_end(components)
+        return rowid
+
+    def longest_prefix(self, components: tuple[str, ...]) -> tuple[int, int]:
+        """Return length and rowid of the longest cached prefix of
+        `components`.
+
+        Statistics are not affected. The root is always known.
+        """
+        for i in range(len(components), 0, -1):
+            rowid = self._rowids.get(components[:i])
+            if rowid is not None:
+                self._rowids.move_to_end(components[:i])
+                return i, rowid
+        # Root should be stored under rowid 1 in the database
+        return 0, 1
+
+    def put(self, components: tuple[str, ...], rowid: int):
+        self._rowids[components] = rowid
+        self._rowids.move_to_end(components)
+        if len(self._rowids) > self.maxsize:
+            self._rowids.popitem(last=False)
+
+    def invalidate(self, components: tuple[str, ...] = ()):
+        """Forget the directory with `components` and everything under it.
+
+        Everything is forgotten by default. Statistics are kept.
+        """
+        if not components:
+            self._rowids.clear()
+            return
+        n = len(components)
+        for key in [k for k in self._rowids if k[:n] == components]:
+            del self._rowids[key]
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._rowids))
+
+
+def _selinux_reference_results(
+    accesses: list[tuple],
+    perms: tuple[str, ...],
+    perms_id: list[int],
+    cache: DecisionCache,
+    verbose: bool,
+) -> tuple[list[tuple[int, int, int]], list[str]]:
+    """Compute reference results of pending accesses.
+
+    :param accesses: rows selected by `fill_missing_selinux_accesses`.
+    :returns: `(access_id, operation_id, result)` to be inserted and verbose
+    messages.
+    """
+    results = []
+    messages = []
+    # Unlabeled files are looked up at once, with one selabel handle
+    labels = iter(
+        selinux_label_lookup_many(
+            (row[4], row[5]) for row in accesses if row[6] is None
+        )
+    )
+    for (
+        access_id,
+        subject_cid,
+        subject_context,
+        node_rowid,
+        path,
+        _type,
+        selinux_context,
+        operation_id,
+        operation,
+        reference_result,
+    ) in accesses:
+        if selinux_context is None:
+            selinux_context = next(labels)
+        if selinux_context is None:
+            # Nothing to do here, we have to skip this path from evaluation
+            continue
+
+        is_dir = stat.S_ISDIR(_type)
+        _class = 'dir' if is_dir else 'file'
+
+        if operation_id is None:
+            # Compute access permissions for all operations
+            for perm, perm_id in zip(perms, perms_id):
+                result = cache.check(
+                    subject_context, selinux_context, _class, perm
+                )
+                if verbose:
+                    messages.append(
+                        f'{subject_context}=>{selinux_context} {path} ({_class}:{perm})={result}'
+                    )
+                results.append((access_id, perm_id, result))
+            continue
+        # Updating just one operation
+        result = cache.check(
+            subject_context, selinux_context, _class, operation
+        )
+        if verbose:
+            messages.append(
+                f'{subject_context}=>{selinux_context} {path} ({_class}:{operation})={result}'
+            )
+        results.append((access_id, operation_id, result))
+    return results, messages
+
+
+# Decision cache of a worker process of `fill_missing_selinux_accesses`
+_worker_cache = None
+
+
+def _init_selinux_worker(decisions: dict):
+    global _worker_cache
+    # Decisions are sent back to the parent, which stores them
+    _worker_cache = DecisionCache(None, None, decisions)
+
+
+def _selinux_worker(
+    args: tuple[list[tuple], tuple[str, ...], list[int], bool]
+) -> tuple[list[tuple[int, int, int]], list[str], dict, int, int]:
+    """Compute reference results of a chunk of accesses in a worker process.
+
+    :returns: results and messages of `_selinux_reference_results`, new
+    decisions and hit and miss counts of the chunk.
+    """
+    accesses, perms, perms_id, verbose = args
+    results, messages = _selinux_reference_results(
+        accesses, perms, perms_id, _worker_cache, verbose
+    )
+    hits, misses = _worker_cache.hits, _worker_cache.misses
+    _worker_cache.hits = _worker_cache.misses = 0
+    return results, messages, _worker_cache.take_new(), hits, misses
 
 
 class DatabaseCommon:
     def get_paths_by_selinux_type(self, types: Iterable[str]):
         """Return list of paths that match types listed in `_types`."""
-        expr = (f'selinux_type == "{t}"' for t in types)
-        select = f'''WITH RECURSIVE child AS
-(
-  SELECT rowid AS original, rowid, parent, name, type, selinux_user, selinux_role, selinux_type, selinux_sensitivity, selinux_category
-  FROM fs
-  WHERE ({" OR ".join(expr)})
-
-  UNION ALL
-
-  SELECT original, fs.rowid, fs.parent, fs.name || '/' || child.name, child.type, child.selinux_user, child.selinux_role, child.selinux_type, child.selinux_sensitivity, child.selinux_category
-  FROM fs, child
-  WHERE child.parent = fs.rowid
-)
-SELECT original, name, type, selinux_user, selinux_role, selinux_type, selinux_sensitivity, selinux_category
-From child
-WHERE rowid = 1'''
-        res = self.cur.execute(select)
+        types = tuple(types)
+        select = f'''SELECT rowid, path, type, selinux_user, selinux_role, selinux_type, selinux_sensitivity, selinux_category
+FROM fs_view
+WHERE context_id IN (SELECT rowid FROM object_contexts
+                     WHERE type IN ({", ".join("?" * len(types))}))'''
+        res = self.cur.execute(select, types)
         return res.fetchall()
         return list(chain.from_iterable(res.fetchall()))
 
@@ -160,6 +437,24 @@ WHERE rowid = 1'''
         )
         return res.fetchall()
 
+    def get_inode(self, rowid: int) -> Inode | None:
+        """Return inode metadata of the dentry with `rowid`."""
+        res = self.cur.execute(
+            f'SELECT {INODE_COLUMNS} FROM fs_view WHERE rowid = ?', (rowid,)
+        )
+        row = res.fetchone()
+        if row is None:
+            return None
+        return Inode(*row)
+
+    def get_children(self, parent_rowid: int) -> list[tuple[int, Inode]]:
+        """Return rowids and inode metadata of dentries inside `parent_rowid`."""
+        res = self.cur.execute(
+            f'SELECT rowid, {INODE_COLUMNS} FROM fs_view WHERE parent = ?',
+            (parent_rowid,),
+        )
+        return [(row[0], Inode(*row[1:])) for row in res]
+
     def get_specific_child(self, parent_rowid: int, name: str) -> int | None:
         """Get child in a folder.
 
@@ -176,30 +471,6 @@ WHERE rowid = 1'''
             return None
         return row[0]
 
-    def _get_permission_confusion_count(
-        self,
-        case_id: int,
-        subject_cid: int,
-        eval_case_id: int,
-        reference_result: int,
-        medusa_result: int,
-    ) -> int:
-        ret = self.cur.execute(
-            ''' SELECT COUNT(*)
- FROM accesses
- LEFT JOIN results ON accesses.ROWID = results.access_id
- LEFT JOIN medusa_results ON results.rowid = medusa_results.result_id
- WHERE case_id = ? AND subject_cid = ? AND eval_case_id = ? AND reference_result = ? AND medusa_result = ?''',
-            (
-                case_id,
-                subject_cid,
-                eval_case_id,
-                reference_result,
-                medusa_result,
-            ),
-        )
-        return ret.fetchone()[0]
-
     def _get_permission_confusion_pretty_list(
         self,
         case_id: int,
@@ -210,58 +481,22 @@ WHERE rowid = 1'''
     ) -> DataFrame:
         """Pretty-printed list of files with a given confusion."""
         return read_sql_query(
-            '''WITH RECURSIVE child AS
-  (SELECT accesses.case_id,
-          accesses.node_rowid,
-          accesses.subject_cid,
-          cases.name AS case_name,
-          contexts.name AS subject_context,
-          fs.rowid,
-          fs.parent,
-          fs.name,
-          fs.selinux_user,
-          fs.selinux_role,
-          fs.selinux_type,
-          fs.selinux_category,
-	  fs.selinux_sensitivity,
-          operation,
-          results.reference_result,
-		  medusa_results.eval_case_id,
-		  eval_cases.eval_case,
-          medusa_results.medusa_result
+            '''SELECT contexts.name AS subject_context,
+       fs.path AS name,
+       operation,
+       object_contexts.context AS object_context,
+       results.reference_result,
+       medusa_results.medusa_result
    FROM accesses
    JOIN cases ON case_id = cases.rowid
    JOIN contexts ON subject_cid = contexts.rowid
    JOIN fs ON node_rowid = fs.rowid
+   LEFT JOIN object_contexts ON fs.context_id = object_contexts.rowid
    LEFT JOIN results ON accesses.ROWID = results.access_id
    LEFT JOIN operations ON results.operation_id = operations.rowid
    LEFT JOIN medusa_results ON results.rowid = medusa_results.result_id
    JOIN eval_cases ON medusa_results.eval_case_id = eval_cases.rowid
-   WHERE case_id = ? AND subject_cid = ? AND eval_case_id = ? AND reference_result = ? AND medusa_result = ?
-   UNION ALL SELECT case_id,
-                    node_rowid,
-                    subject_cid,
-                    case_name,
-                    subject_context,
-                    fs.rowid,
-                    fs.parent,
-                    fs.name || '/' || child.name,
-                    child.selinux_user,
-                    child.selinux_role,
-                    child.selinux_type,
-                    child.selinux_category,
-                    child.selinux_sensitivity,
-                    operation,
-                    reference_result,
-		    eval_case_id,
-		    eval_case,
-                    medusa_result
-   FROM fs,
-        child
-   WHERE child.parent = fs.rowid )
-SELECT subject_context, name, operation, selinux_user || ':' || selinux_role || ':' || selinux_type || ':' || selinux_sensitivity || COALESCE(':' || selinux_category, '') AS object_context, reference_result, medusa_result
-FROM child
-WHERE rowid = 1''',
+   WHERE case_id = ? AND subject_cid = ? AND eval_case_id = ? AND reference_result = ? AND medusa_result = ?''',
             self.con,
             params=(
                 case_id,
@@ -305,23 +540,73 @@ WHERE rowid = 1''',
         subject_context_groups: Iterable[Iterable[str]],
         eval_case: str,
     ) -> Result:
+        matrix = self.get_permission_confusion_matrix(
+            case, subject_context_groups, eval_case
+        )
+        return matrix.get(eval_case, Result(0, 0, 0, 0))
+
+    def get_permission_confusion_matrix(
+        self,
+        case: str,
+        subject_context_groups: Iterable[Iterable[str]],
+        eval_case: str | None = None,
+    ) -> dict[str, Result]:
+        """Return confusion of every eval case of `case` at once.
+
+        All counts are computed by a single grouped scan of the results
+        tables, instead of one query per subject context, confusion and eval
+        case.
+
+        :param subject_context_groups: subject contexts whose accesses are
+        summed. A context listed more than once is counted more than once, as
+        in `get_permission_confusion`.
+        :param eval_case: compute only this eval case. Medusa results of
+        other eval cases are then skipped through the primary key of
+        medusa_results.
+        :returns: `Result` keyed by the name of the eval case. Eval cases
+        without any results are missing.
+        """
         case_id = self.get_case_id(case)
-        subject_cids = [
-            self.get_context_id(context)
-            for context in chain.from_iterable(subject_context_groups)
-        ]
-        eval_case_id = self.get_eval_case(eval_case)
-        results = ((1, 1), (0, 0), (0, 1), (1, 0))
-        ret = [
-            [
-                self._get_permission_confusion_count(
-                    case_id, subject_cid, eval_case_id, *result
-                )
-                for result in results
-            ]
-            for subject_cid in subject_cids
-        ]
-        return Result(*(sum(x) for x in zip(*ret)))
+        if eval_case is None:
+            eval_filter = ''
+            eval_params = ()
+        else:
+            eval_case_id = self.get_eval_case(eval_case)
+            if eval_case_id is None:
+                return {}
+            eval_filter = 'AND medusa_results.eval_case_id = ?'
+            eval_params = (eval_case_id,)
+        multiplicity = {}
+        for context in chain.from_iterable(subject_context_groups):
+            cid = self.get_context_id(context)
+            multiplicity[cid] = multiplicity.get(cid, 0) + 1
+        res = self.cur.execute(
+            f'''SELECT subject_cid, eval_case, reference_result, medusa_result,
+                       COUNT(*)
+                FROM accesses
+                JOIN results ON accesses.rowid = results.access_id
+                JOIN medusa_results ON results.rowid = medusa_results.result_id
+                JOIN eval_cases ON medusa_results.eval_case_id = eval_cases.rowid
+                WHERE case_id = ?
+                  AND subject_cid IN ({", ".join("?" * len(multiplicity))})
+                  {eval_filter}
+                GROUP BY subject_cid, eval_case_id, reference_result,
+                         medusa_result''',
+            (case_id, *multiplicity, *eval_params),
+        )
+        # Positions of (reference_result, medusa_result) in `Result`
+        positions = {(1, 1): 0, (0, 0): 1, (0, 1): 2, (1, 0): 3}
+        counts = {}
+        for subject_cid, eval_case, reference, medusa, count in res:
+            position = positions.get((reference, medusa))
+            if position is None:
+                continue
+            counts.setdefault(eval_case, [0, 0, 0, 0])[position] += (
+                count * multiplicity[subject_cid]
+            )
+        return {
+            eval_case: Result(*count) for eval_case, count in counts.items()
+        }
 
     def is_directory(self, path: str) -> bool:
         """Return `True` if `path` points to a directory.
@@ -342,64 +627,211 @@ WHERE rowid = 1''',
     ) -> tuple | Inode | list[Inode] | int:
         """Return inode metadata from the database if it exists.
 
+        Rowids of directories on the way are taken from the path cache, see
+        `resolve_components`.
+
         :param path: Return inode metadata of object at this path.
         :param children: If `True`, return children items of `path`.
         """
         entries = tuple(self._create_path(path))
+        if not entries:
+            return tuple()
 
-        # Root should be stored under rowid 1 in the database
-        current_folder = 1
-
-        for i, e in enumerate(entries):
-            if i == len(entries) - 1:
-                # Final path component
-                if not children:
-                    # Just return inode metadata about the last component
-                    res = self.cur.execute(
-                        'SELECT * FROM fs WHERE parent = ? AND name = ?',
-                        (current_folder, e),
-                    )
-                    row = res.fetchone()
-                    if row is None:
-                        # path doesn't exist
-                        return tuple()
-                    return Inode(*row)
-                # Get ID of the last component
-                res = self.cur.execute(
-                    'SELECT rowid FROM fs WHERE parent = ? AND name = ?',
-                    (current_folder, e),
-                )
-                row = res.fetchone()
-                if row is None:
-                    # path doesn't exist
-                    return tuple()
-                current_folder = row[0]
-                if number:
-                    # Get just the number of items
-                    res = self.cur.execute(
-                        'SELECT COUNT(*) FROM fs WHERE parent = ?',
-                        (current_folder,),
-                    )
-                    row = res.fetchone()
-                    return row[0]
-                # Continue with contents of this directory
-                res = self.cur.execute(
-                    'SELECT * FROM fs WHERE parent = ?',
-                    (current_folder,),
-                )
-                rows = res.fetchall()
-                return [Inode(*x) for x in rows]
-
+        if not children:
+            # Just return inode metadata about the last component
+            parent = self.resolve_components(entries[:-1])
+            if parent is None:
+                # Directory does not exist
+                return tuple()
             res = self.cur.execute(
-                'SELECT rowid FROM fs WHERE parent = ? AND name = ?',
-                (current_folder, e),
+                f'''SELECT {INODE_COLUMNS} FROM fs_view
+                    WHERE parent = ? AND name = ?''',
+                (parent, entries[-1]),
             )
-            if (row := res.fetchone()) is None:
-                # Directory does not exist
+            row = res.fetchone()
+            if row is None:
+                # path doesn't exist
                 return tuple()
-            current_folder = row[0]
+            return Inode(*row)
+
+        current_folder = self.resolve_components(entries)
+        if current_folder is None:
+            # path doesn't exist
+            return tuple()
+        if number:
+            # Get just the number of items
+            res = self.cur.execute(
+                'SELECT COUNT(*) FROM fs WHERE parent = ?',
+                (current_folder,),
+            )
+            row = res.fetchone()
+            return row[0]
+        # Continue with contents of this directory
+        res = self.cur.execute(
+            f'SELECT {INODE_COLUMNS} FROM fs_view WHERE parent = ?',
+            (current_folder,),
+        )
+        rows = res.fetchall()
+        return [Inode(*x) for x in rows]
+
+    def resolve_components(self, components: tuple[str, ...]) -> int | None:
+        """Return rowid of the dentry at path `components` below the root.
 
-        return tuple()
+        Directories are looked up in the LRU path cache first. On a miss, the
+        rest of the path after the longest cached prefix is resolved by a
+        single recursive query, and directories found on the way are cached.
+
+        :returns: `None` if the path doesn't exist.
+        """
+        if not components:
+            # Root should be stored under rowid 1 in the database
+            return 1
+        cache = self.path_cache
+        rowid = cache.get(components)
+        if rowid is not None:
+            return rowid
+        start, rowid = cache.longest_prefix(components)
+        res = self.cur.execute(
+            f'''WITH RECURSIVE walk(depth, rowid, type) AS
+               (
+                 SELECT 0, ?, {stat.S_IFDIR}
+                 UNION ALL
+                 SELECT walk.depth + 1, fs.rowid, fs.type
+                 FROM walk
+                 JOIN fs ON fs.parent = walk.rowid
+                   AND fs.name = json_extract(?, '$[' || walk.depth || ']')
+                 WHERE walk.type = {stat.S_IFDIR}
+               )
+               SELECT depth, rowid, type FROM walk WHERE depth > 0''',
+            (rowid, json.dumps(components[start:], ensure_ascii=False)),
+        )
+        for depth, rowid, _type in res.fetchall():
+            if _type == stat.S_IFDIR:
+                cache.put(components[: start + depth], rowid)
+            if start + depth == len(components):
+                return rowid
+        return None
+
+    def search_paths(
+        self, paths: Iterable[str], chunk_size: int = 50000
+    ) -> Iterator[Inode | None]:
+        """Yield inode metadata of every path in `paths` in input order.
+
+        Paths are resolved in chunks of `chunk_size`. Each chunk is loaded
+        into temporary tables and resolved by one set-based join per path
+        depth, so `paths` can be a lazy iterable larger than memory. Unlike
+        `search_path`, `/` yields the root.
+
+        Generators returned by this method use the same temporary tables and
+        must not be consumed concurrently.
+
+        :returns: `Inode` of every path, `None` for paths that don't exist.
+        """
+        # Components of every path are stored as a JSON array
+        self.cur.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS lookup_paths(
+                 idx INTEGER PRIMARY KEY, components TEXT, length INTEGER,
+                 current INTEGER)"""
+        )
+        paths = iter(paths)
+        while chunk := list(islice(paths, chunk_size)):
+            # Writes to the temporary tables would otherwise open a
+            # transaction that is never committed and keeps the shared lock
+            # and the snapshot of the database. The savepoint is nested in
+            # a transaction of the caller if there is one.
+            self.cur.execute('SAVEPOINT search_paths')
+            try:
+                rows = self._search_chunk(chunk)
+            finally:
+                self.cur.execute('RELEASE search_paths')
+            for row in rows:
+                yield None if row[0] is None else Inode(*row[1:])
+
+    def _search_chunk(self, chunk: list[str]) -> list[tuple]:
+        """Resolve `chunk` of `search_paths` through `temp.lookup_paths`."""
+        self.cur.execute('DELETE FROM temp.lookup_paths')
+        components = [tuple(self._create_path(p)) for p in chunk]
+        # Root should be stored under rowid 1 in the database
+        self.cur.executemany(
+            'INSERT INTO temp.lookup_paths VALUES(?, ?, ?, 1)',
+            (
+                (i, json.dumps(c, ensure_ascii=False), len(c))
+                for i, c in enumerate(components)
+            ),
+        )
+        for depth in range(max(map(len, components))):
+            self.cur.execute(
+                """UPDATE temp.lookup_paths
+                   SET current = (SELECT rowid FROM fs
+                                  WHERE parent = lookup_paths.current
+                                    AND name = json_extract(components, ?))
+                   WHERE length > ? AND current IS NOT NULL""",
+                (f'$[{depth}]', depth),
+            )
+        # fs_view would be materialized as the right side of LEFT JOIN
+        res = self.cur.execute(
+            f"""SELECT fs.rowid,
+                       {', '.join(f'fs.{c}' for c in Inode._fields[:-5])},
+                       object_contexts.user,
+                       object_contexts.role,
+                       object_contexts.type,
+                       object_contexts.sensitivity,
+                       object_contexts.category
+                FROM temp.lookup_paths
+                LEFT JOIN fs ON fs.rowid = lookup_paths.current
+                LEFT JOIN object_contexts
+                  ON fs.context_id = object_contexts.rowid
+                ORDER BY lookup_paths.idx"""
+        )
+        # Fetched at once, so the savepoint is released before the rows are
+        # yielded and other queries can run between yields
+        return res.fetchall()
+
+    def get_effective_access(self, uid: int, permission: int) -> bytes | None:
+        """Return bitmap stored by `dac.DacEngine.store_effective_access`.
+
+        :param permission: combination of rwx bits of a single class.
+        """
+        res = self.cur.execute(
+            'SELECT bitmap FROM effective_access WHERE uid = ? AND permission = ?',
+            (uid, permission),
+        )
+        row = res.fetchone()
+        return None if row is None else row[0]
+
+    def has_effective_access(
+        self, rowid: int, uid: int, permission: int
+    ) -> bool | None:
+        """Check if `uid` can access the dentry with `rowid` with all
+        `permission` bits through searchable directories.
+
+        Only the byte of the stored bitmap holding `rowid` is read.
+
+        :returns: `None` if no bitmap is stored for `uid` and `permission`.
+        """
+        res = self.cur.execute(
+            '''SELECT substr(bitmap, ?, 1) FROM effective_access
+               WHERE uid = ? AND permission = ?''',
+            (rowid // 8 + 1, uid, permission),
+        )
+        row = res.fetchone()
+        if row is None:
+            return None
+        return bool(row[0] and row[0][0] >> rowid % 8 & 1)
+
+    def path_cache_info(self) -> CacheInfo:
+        """Return hit and miss statistics of the path cache."""
+        return self.path_cache.info()
+
+    def invalidate_path_cache(self, path: str = '/'):
+        """Forget cached rowids of the directory at `path` and everything
+        under it.
+
+        Has to be called after the tree in the database is changed by another
+        connection. Changes made through `DatabaseCreator` invalidate the
+        cache automatically.
+        """
+        self.path_cache.invalidate(tuple(self._create_path(path)))
 
     @staticmethod
     def _create_path(path: str):
@@ -424,33 +856,165 @@ WHERE rowid = 1''',
 
         Directories are matched based on `uid` or `gid`."""
         res = self.cur.execute(
-            f'''WITH RECURSIVE child AS
-        (
-          SELECT rowid AS original, rowid, parent, name, type, mode
-          FROM fs
-          WHERE type = {stat.S_IFDIR}
-          AND (uid IN ({",".join(str(x) for x in uids)})
-               OR gid IN ({",".join(str(x) for x in gids)}))
+            f'''SELECT path, mode
+        FROM fs
+        WHERE type = {stat.S_IFDIR}
+        AND (uid IN ({",".join(str(x) for x in uids)})
+             OR gid IN ({",".join(str(x) for x in gids)}))'''
+        )
+        return res.fetchall()
+
+    def get_rowid(self, path: str) -> int | None:
+        """Return rowid of the dentry at `path`, `None` if it doesn't exist."""
+        return self.resolve_components(tuple(self._create_path(path)))
 
-          UNION ALL
+    def get_subtree_range(self, rowid: int) -> tuple[int, int] | None:
+        """Return `(dfs_enter, dfs_exit)` of the dentry with `rowid`.
 
-          SELECT original, fs.rowid, fs.parent, fs.name || '/' || child.name, child.type, child.mode
-          FROM fs, child
-          WHERE child.parent = fs.rowid
+        Rows with `dfs_enter` in this closed interval form the subtree of the
+        dentry, including the dentry itself.
+        """
+        res = self.cur.execute(
+            'SELECT dfs_enter, dfs_exit FROM fs WHERE rowid = ?', (rowid,)
         )
-        SELECT name, mode
-        From child
-        WHERE rowid = 1'''
+        return res.fetchone()
+
+    def is_in_subtree(self, rowid: int, ancestor_rowid: int) -> bool:
+        """Check if the dentry with `rowid` is `ancestor_rowid` or lies
+        under it."""
+        res = self.cur.execute(
+            '''SELECT a.dfs_enter <= d.dfs_enter AND d.dfs_enter <= a.dfs_exit
+               FROM fs AS d, fs AS a
+               WHERE d.rowid = ? AND a.rowid = ?''',
+            (rowid, ancestor_rowid),
         )
-        return res.fetchall()
+        row = res.fetchone()
+        return bool(row and row[0])
+
+    def _subtree_filter(
+        self,
+        path: str,
+        types: Iterable[int] | None,
+        uids: Iterable[int] | None,
+        selinux_types: Iterable[str] | None,
+    ) -> tuple[str, list] | None:
+        """Build WHERE clause selecting the subtree at `path` from fs.
+
+        :returns: The clause and its parameters, `None` if `path` doesn't
+        exist.
+        """
+        rowid = self.get_rowid(path)
+        if rowid is None:
+            return None
+        where = ['fs.dfs_enter BETWEEN ? AND ?']
+        params = list(self.get_subtree_range(rowid))
+        for column, values in (('fs.type', types), ('fs.uid', uids)):
+            if values is not None:
+                values = tuple(values)
+                where.append(f'{column} IN ({", ".join("?" * len(values))})')
+                params.extend(values)
+        if selinux_types is not None:
+            selinux_types = tuple(selinux_types)
+            where.append(
+                f'''fs.context_id IN (SELECT rowid FROM object_contexts
+                    WHERE type IN ({", ".join("?" * len(selinux_types))}))'''
+            )
+            params.extend(selinux_types)
+        return ' AND '.join(where), params
+
+    def count_subtree(
+        self,
+        path: str,
+        types: Iterable[int] | None = None,
+        uids: Iterable[int] | None = None,
+        selinux_types: Iterable[str] | None = None,
+    ) -> int:
+        """Return number of dentries in the subtree at `path`.
+
+        The dentry at `path` is counted too, if it matches the filters.
+
+        :param types: count only dentries with these file types
+        (`stat.S_IFDIR`, `stat.S_IFREG`, ...).
+        :param uids: count only dentries owned by these users.
+        :param selinux_types: count only dentries with these SELinux types.
+        """
+        subtree = self._subtree_filter(path, types, uids, selinux_types)
+        if subtree is None:
+            return 0
+        where, params = subtree
+        res = self.cur.execute(f'SELECT COUNT(*) FROM fs WHERE {where}', params)
+        return res.fetchone()[0]
+
+    def iter_subtree(
+        self,
+        path: str,
+        types: Iterable[int] | None = None,
+        uids: Iterable[int] | None = None,
+        selinux_types: Iterable[str] | None = None,
+    ) -> Iterator[tuple[int, Inode]]:
+        """Yield rowids and inode metadata of dentries in the subtree at
+        `path` in depth-first order.
+
+        Filters are the same as in `count_subtree`.
+        """
+        subtree = self._subtree_filter(path, types, uids, selinux_types)
+        if subtree is None:
+            return
+        where, params = subtree
+        # Separate cursor, so other queries can run while iterating
+        res = self.con.execute(
+            f'''SELECT rowid, {INODE_COLUMNS} FROM fs_view AS fs
+                WHERE {where} ORDER BY fs.dfs_enter''',
+            params,
+        )
+        for row in res:
+            yield row[0], Inode(*row[1:])
+
+    def count_subtree_accesses(self, path: str, case: str | None = None) -> int:
+        """Return number of accesses to dentries in the subtree at `path`.
+
+        :param case: count only accesses of this case.
+        """
+        rowid = self.get_rowid(path)
+        if rowid is None:
+            return 0
+        params = list(self.get_subtree_range(rowid))
+        where = 'fs.dfs_enter BETWEEN ? AND ?'
+        if case is not None:
+            where += ' AND accesses.case_id = ?'
+            params.append(self.get_case_id(case))
+        res = self.cur.execute(
+            f'''SELECT COUNT(*) FROM accesses
+                JOIN fs ON accesses.node_rowid = fs.rowid
+                WHERE {where}''',
+            params,
+        )
+        return res.fetchone()[0]
 
 
 class DatabaseWriter(DatabaseCommon):
     """Database with read-write support."""
 
-    def __init__(self, path: str):
+    def __init__(
+        self, path: str, path_cache_size: int = 65536, wal: bool = False
+    ):
+        """Create `DatabaseWriter`.
+
+        :param path_cache_size: maximum number of directories in the path
+        cache.
+        :param wal: switch the database to write-ahead log, so readers from
+        `DatabaseReadPool` aren't blocked while it is written.
+        """
         self.con = sqlite3.connect(path, isolation_level=None)
         self.cur = self.con.cursor()
+        self.wal = wal
+        if wal:
+            self.cur.execute('PRAGMA journal_mode = WAL')
+            # Durable at checkpoints, commits don't wait for fsync
+            self.cur.execute('PRAGMA synchronous = NORMAL')
+        self.path_cache = PathCache(path_cache_size)
+        # Created on first use, hashing the policy needs SELinux
+        self._decision_cache = None
         self._prepare_accesses()
 
     def insert_access(
@@ -499,6 +1063,23 @@ class DatabaseWriter(DatabaseCommon):
         else:
             raise Exception('One of the results has to be None.')
 
+    def insert_ref_results(self, results: Iterable[tuple[int, int, int]]):
+        """Insert or update reference results in a single transaction.
+
+        :param results: tuples of `(access_id, operation_id, result)`.
+        """
+        own_transaction = not self.con.in_transaction
+        if own_transaction:
+            self.cur.execute('BEGIN TRANSACTION')
+        self.cur.executemany(
+            '''INSERT INTO results VALUES(?, ?, ?)
+            ON CONFLICT (access_id, operation_id)
+            DO UPDATE SET reference_result = excluded.reference_result''',
+            results,
+        )
+        if own_transaction:
+            self.cur.execute('END TRANSACTION')
+
     def insert_or_select_result(
         self, access_id: int, operation_id: int, result_ref: int
     ) -> int:
@@ -544,6 +1125,60 @@ class DatabaseWriter(DatabaseCommon):
         )
         return self.cur.lastrowid
 
+    def bulk_insert_ref_results(
+        self,
+        results: Iterable[tuple[int, int, int, int, int]],
+        batch_size: int = 100000,
+    ):
+        """Insert accesses together with their reference results.
+
+        Batches of `results` are loaded into a staging table and moved into
+        the accesses and results tables by two `INSERT ... SELECT`
+        statements, each batch in a single transaction. The outcome is the
+        same as calling `insert_or_select_access` and `insert_ref_result` for
+        every item.
+
+        :param results: tuples of `(case_id, subject_cid, node_rowid,
+        operation_id, reference_result)`.
+        """
+        self.cur.execute(
+            '''CREATE TEMP TABLE IF NOT EXISTS staged_results(
+               case_id INTEGER,
+               subject_cid INTEGER,
+               node_rowid INTEGER,
+               operation_id INTEGER,
+               reference_result INTEGER)'''
+        )
+        results = iter(results)
+        while batch := list(islice(results, batch_size)):
+            # `DatabaseCreator` keeps a transaction open all the time
+            own_transaction = not self.con.in_transaction
+            if own_transaction:
+                self.cur.execute('BEGIN TRANSACTION')
+            self.cur.execute('DELETE FROM temp.staged_results')
+            self.cur.executemany(
+                'INSERT INTO temp.staged_results VALUES(?, ?, ?, ?, ?)', batch
+            )
+            # Existing accesses are ignored by the UNIQUE constraint
+            self.cur.execute(
+                '''INSERT INTO accesses (case_id, subject_cid, node_rowid)
+                   SELECT case_id, subject_cid, node_rowid
+                   FROM temp.staged_results ORDER BY rowid'''
+            )
+            self.cur.execute(
+                '''INSERT INTO results (access_id, operation_id, reference_result)
+                   SELECT accesses.rowid, staged.operation_id,
+                          staged.reference_result
+                   FROM temp.staged_results AS staged
+                   JOIN accesses USING (case_id, subject_cid, node_rowid)
+                   WHERE true
+                   ORDER BY staged.rowid
+                   ON CONFLICT (access_id, operation_id)
+                   DO UPDATE SET reference_result = excluded.reference_result'''
+            )
+            if own_transaction:
+                self.cur.execute('END TRANSACTION')
+
     def insert_or_select_access(
         self, case_id: int, subject_cid: int, path_rowid: int
     ) -> int:
@@ -611,47 +1246,54 @@ class DatabaseWriter(DatabaseCommon):
         files = self.get_paths_by_selinux_type(object_types)
         perms = ('read', 'write')
         perms_id = self.get_operations_id(perms)
-        for (
-            path_rowid,
-            path,
-            _type,
-            selinux_user,
-            selinux_role,
-            selinux_type,
-            selinux_sensitivity,
-            selinux_category,
-        ) in files:
-            context = construct_selinux_context(
+
+        def results():
+            for (
+                path_rowid,
+                path,
+                _type,
                 selinux_user,
                 selinux_role,
                 selinux_type,
                 selinux_sensitivity,
                 selinux_category,
-            )
-            is_dir = stat.S_ISDIR(_type)
-            _class = 'dir' if is_dir else 'file'
-
-            results = [
-                selinux_check_access(subject_context, context, _class, perm)
-                for perm in perms
-            ]
-            if verbose:
-                for perm, result in zip(perms, results):
-                    print(
-                        f'{subject_context}=>{context} {path} ({_class}:{perm})={result}'
-                    )
-            for subject_cid in subject_cids:
-                access_id = self.insert_or_select_access(
-                    case_id, subject_cid, path_rowid
+            ) in files:
+                context = construct_selinux_context(
+                    selinux_user,
+                    selinux_role,
+                    selinux_type,
+                    selinux_sensitivity,
+                    selinux_category,
                 )
+                is_dir = stat.S_ISDIR(_type)
+                _class = 'dir' if is_dir else 'file'
 
-                for perm_id, result in zip(perms_id, results):
-                    self.insert_ref_result(access_id, perm_id, result)
+                results = [
+                    self.decision_cache.check(
+                        subject_context, context, _class, perm
+                    )
+                    for perm in perms
+                ]
+                if verbose:
+                    for perm, result in zip(perms, results):
+                        print(
+                            f'{subject_context}=>{context} {path} ({_class}:{perm})={result}'
+                        )
+                for subject_cid in subject_cids:
+                    for perm_id, result in zip(perms_id, results):
+                        yield case_id, subject_cid, path_rowid, perm_id, result
+
+        self.bulk_insert_ref_results(results())
+        self.decision_cache.flush()
+        if verbose:
+            print(self.decision_cache_info())
 
     def fill_missing_selinux_accesses(
         self,
         case_name: str,
         verbose: bool = False,
+        processes: int = 1,
+        chunk_size: int = 4096,
     ):
         """Fill missing accesses for SELinux in the database.
 
@@ -661,119 +1303,81 @@ class DatabaseWriter(DatabaseCommon):
         :param case_name: Name of the service that is examined. This will be
         used as a unique value in the database.
         :param verbose: Turns on verbose output.
+        :param processes: number of worker processes that call libselinux.
+        Pending accesses are split into chunks of `chunk_size`, results are
+        written by this process, one transaction per chunk, in the same order
+        as in the serial case.
         """
         perms = ('read', 'write')
         perms_id = self.get_operations_id(perms)
         case_id = self.get_case_id(case_name)
 
         res = self.cur.execute(
-            """WITH RECURSIVE child AS
-  (SELECT accesses.rowid AS access_rowid,
-          accesses.node_rowid,
-          accesses.subject_cid,
-          contexts.name AS subject_context,
-          fs.rowid,
-          fs.parent,
-          fs.name,
-          type,
-          fs.selinux_user,
-          fs.selinux_role,
-          fs.selinux_type,
-          fs.selinux_category,
-          fs.selinux_sensitivity,
-          operations.rowid AS operation_id,
-          operation,
-          results.reference_result
+            """SELECT accesses.rowid AS access_rowid,
+       subject_cid,
+       contexts.name AS subject_context,
+       node_rowid,
+       fs.path,
+       fs.type,
+       object_contexts.context AS selinux_context,
+       operations.rowid AS operation_id,
+       operation,
+       results.reference_result
    FROM accesses
    JOIN contexts ON subject_cid = contexts.rowid
    JOIN fs ON node_rowid = fs.rowid
+   LEFT JOIN object_contexts ON fs.context_id = object_contexts.rowid
    LEFT JOIN results ON accesses.ROWID = results.access_id
    LEFT JOIN operations ON results.operation_id = operations.rowid
    WHERE case_id = ?
      AND reference_result IS NULL
-   UNION ALL SELECT access_rowid,
-                    node_rowid,
-                    subject_cid,
-                    subject_context,
-                    fs.rowid,
-                    fs.parent,
-                    fs.name || '/' || child.name,
-                    child.type,
-                    child.selinux_user,
-                    child.selinux_role,
-                    child.selinux_type,
-                    child.selinux_category,
-                    child.selinux_sensitivity,
-                    operation_id,
-                    operation,
-                    reference_result
-   FROM fs,
-        child
-   WHERE child.parent = fs.rowid )
-SELECT access_rowid,
-       subject_cid,
-       subject_context,
-       node_rowid,
-       name AS path,
-       TYPE,
-       selinux_user || ':' || selinux_role || ':' || selinux_type || ':' || selinux_sensitivity || COALESCE(':' || selinux_category, '') AS selinux_context,
-       operation_id,
-       operation,
-       reference_result
-FROM child
-WHERE rowid = 1
         """,
             (case_id,),
         )
         accesses = res.fetchall()
-        for (
-            access_id,
-            subject_cid,
-            subject_context,
-            node_rowid,
-            path,
-            _type,
-            selinux_context,
-            operation_id,
-            operation,
-            reference_result,
-        ) in accesses:
-            if selinux_context is None:
-                selinux_context = selinux_label_lookup(path, _type)
-            if selinux_context is None:
-                # Nothing to do here, we have to skip this path from evaluation
-                continue
-
-            is_dir = stat.S_ISDIR(_type)
-            _class = 'dir' if is_dir else 'file'
-
-            if operation_id is None:
-                # Compute access permissions for all operations
-                results = [
-                    selinux_check_access(
-                        subject_context, selinux_context, _class, perm
-                    )
-                    for perm in perms
-                ]
-                if verbose:
-                    for perm, result in zip(perms, results):
-                        print(
-                            f'{subject_context}=>{selinux_context} {path} ({_class}:{perm})={result}'
-                        )
-
-                for perm_id, result in zip(perms_id, results):
-                    self.insert_ref_result(access_id, perm_id, result)
-                continue
-            # Updating just one operation
-            result = selinux_check_access(
-                subject_context, selinux_context, _class, operation
-            )
-            if verbose:
-                print(
-                    f'{subject_context}=>{selinux_context} {path} ({_class}:{operation})={result}'
+        chunks = (
+            accesses[i : i + chunk_size]
+            for i in range(0, len(accesses), chunk_size)
+        )
+        if processes > 1:
+            with multiprocessing.Pool(
+                processes,
+                _init_selinux_worker,
+                (self.decision_cache.decisions(),),
+            ) as pool:
+                # Ordered, so the output is the same as in the serial case
+                for results, messages, decisions, hits, misses in pool.imap(
+                    _selinux_worker,
+                    ((chunk, perms, perms_id, verbose) for chunk in chunks),
+                ):
+                    self.decision_cache.merge(decisions, hits, misses)
+                    for message in messages:
+                        print(message)
+                    self.insert_ref_results(results)
+        else:
+            for chunk in chunks:
+                results, messages = _selinux_reference_results(
+                    chunk, perms, perms_id, self.decision_cache, verbose
                 )
+                for message in messages:
+                    print(message)
+                self.insert_ref_results(results)
+        self.decision_cache.flush()
+        if verbose:
+            print(self.decision_cache_info())
+
+    @property
+    def decision_cache(self) -> DecisionCache:
+        """Cache of SELinux decisions for the currently loaded policy."""
+        if self._decision_cache is None:
+            self._decision_cache = DecisionCache(
+                self.cur, selinux_policy_hash()
+            )
+        return self._decision_cache
 
-            self.insert_ref_result(access_id, operation_id, result)
+    def decision_cache_info(self) -> DecisionCacheInfo:
+        """Return hit and miss statistics of the SELinux decision cache."""
+        return self.decision_cache.info()
 
     def _prepare_accesses(self):
         self.cur.execute(
@@ -840,68 +1444,42 @@ WHERE rowid = 1
             '''CREATE INDEX IF NOT EXISTS eval_case_index
                ON eval_cases (eval_case)'''
         )
+        # Results of `selinux_check_access` under policy with a given hash
+        self.cur.execute(
+            '''CREATE TABLE IF NOT EXISTS selinux_decisions(
+               policy TEXT,
+               scontext TEXT,
+               tcontext TEXT,
+               tclass TEXT,
+               perm TEXT,
+               result INTEGER,
+               PRIMARY KEY (policy, scontext, tcontext, tclass, perm))
+               WITHOUT ROWID'''
+        )
         self.cur.execute(
             """CREATE VIEW IF NOT EXISTS translated_accesses AS
-WITH RECURSIVE child AS
-  (SELECT accesses.case_id,
-          accesses.node_rowid,
-          accesses.subject_cid,
-          cases.name AS case_name,
-          contexts.name AS subject_context,
-          fs.rowid,
-          fs.parent,
-          fs.name,
-          fs.selinux_user,
-          fs.selinux_role,
-          fs.selinux_type,
-          operation,
-          results.reference_result,
-		  medusa_results.eval_case_id,
-		  eval_cases.eval_case,
-          medusa_results.medusa_result
+SELECT accesses.case_id,
+       cases.name AS case_name,
+       accesses.subject_cid,
+       contexts.name AS subject_context,
+       accesses.node_rowid,
+       fs.path AS PATH,
+       fs.selinux_user,
+       fs.selinux_role,
+       fs.selinux_type,
+       operation,
+       results.reference_result,
+       medusa_results.eval_case_id,
+       eval_cases.eval_case,
+       medusa_results.medusa_result
    FROM accesses
    JOIN cases ON case_id = cases.rowid
    JOIN contexts ON subject_cid = contexts.rowid
-   JOIN fs ON node_rowid = fs.rowid
+   JOIN fs_view AS fs ON node_rowid = fs.rowid
    LEFT JOIN results ON accesses.ROWID = results.access_id
    LEFT JOIN operations ON results.operation_id = operations.rowid
    LEFT JOIN medusa_results ON results.rowid = medusa_results.result_id
-   JOIN eval_cases ON medusa_results.eval_case_id = eval_cases.rowid
-   UNION ALL SELECT case_id,
-                    node_rowid,
-                    subject_cid,
-                    case_name,
-                    subject_context,
-                    fs.rowid,
-                    fs.parent,
-                    fs.name || '/' || child.name,
-                    child.selinux_user,
-                    child.selinux_role,
-                    child.selinux_type,
-                    operation,
-                    reference_result,
-					eval_case_id,
-					eval_case,
-                    medusa_result
-   FROM fs,
-        child
-   WHERE child.parent = fs.rowid )
-SELECT case_id,
-       case_name,
-       subject_cid,
-       subject_context,
-       node_rowid,
-       name AS PATH,
-       selinux_user,
-       selinux_role,
-       selinux_type,
-       operation,
-       reference_result,
-	   eval_case_id,
-	   eval_case,
-       medusa_result
-FROM child
-WHERE rowid = 1"""
+   JOIN eval_cases ON medusa_results.eval_case_id = eval_cases.rowid"""
         )
 
     def get_uid_from_name(self, name: str) -> int | None:
@@ -950,30 +1528,91 @@ WHERE rowid = 1"""
 class DatabaseCreator(DatabaseWriter):
     """Creation of the database."""
 
-    def __init__(self, path: str, drop: bool = False):
-        """Create `DatabaseCreator`."""
-        super().__init__(path)
+    def __init__(
+        self,
+        path: str,
+        drop: bool = False,
+        resumable: bool = False,
+        wal: bool = False,
+    ):
+        """Create `DatabaseCreator`.
+
+        :param resumable: Use write-ahead log instead of in-memory journal, so
+        the database stays consistent if the process is killed between
+        checkpoints.
+        :param wal: Keep the database in write-ahead log mode even after
+        `close`, for databases read by `DatabaseReadPool` while they are
+        written.
+        """
+        super().__init__(path, wal=wal)
+        self.resumable = resumable
+        # Cache of rowids from object_contexts keyed by raw xattr values
+        self._object_context_ids = {}
         if drop:
             self.drop_db()
+            # Recreate views that depend on dropped tables
+            self._prepare_accesses()
         self.create_db()
         self.cur.execute('PRAGMA synchronous = OFF')
-        self.cur.execute('PRAGMA journal_mode = MEMORY')
+        if resumable or wal:
+            self.cur.execute('PRAGMA journal_mode = WAL')
+        else:
+            self.cur.execute('PRAGMA journal_mode = MEMORY')
         self.cur.execute('BEGIN TRANSACTION')
 
     def drop_db(self):
         """Drop tables maintained by `DatabaseCreator`."""
+        self.path_cache.invalidate()
         self.cur.executescript(
-            """DROP TABLE IF EXISTS fs;
+            """DROP VIEW IF EXISTS translated_accesses;
+            DROP VIEW IF EXISTS fs_view;
+            DROP TABLE IF EXISTS fs;
+            DROP TABLE IF EXISTS object_contexts;
             DROP TABLE IF EXISTS users;
             DROP TABLE IF EXISTS groups;
             DROP TABLE IF EXISTS membership;
+            DROP TABLE IF EXISTS frontier;
+            DROP TABLE IF EXISTS effective_access;
             """
         )
 
     def create_db(self):
         """Create basic empty tables."""
         self.cur.execute(
-            "CREATE TABLE IF NOT EXISTS fs(parent INTEGER, name TEXT, ino INTEGER, dev INTEGER, nlink INTEGER, uid INTEGER, gid INTEGER, size INTEGER, atime INTEGER, mtime INTEGER, ctime INTEGER, type INTEGER, mode INTEGER, selinux_user TEXT, selinux_role TEXT, selinux_type TEXT, selinux_sensitivity TEXT, selinux_category TEXT)"
+            "CREATE TABLE IF NOT EXISTS fs(parent INTEGER, name TEXT, ino INTEGER, dev INTEGER, nlink INTEGER, uid INTEGER, gid INTEGER, size INTEGER, atime INTEGER, mtime INTEGER, ctime INTEGER, type INTEGER, mode INTEGER, context_id INTEGER, path TEXT, dfs_enter INTEGER, dfs_exit INTEGER)"
+        )
+        # SELinux contexts of files, each distinct context is stored just once
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS object_contexts(context TEXT UNIQUE, user TEXT, role TEXT, type TEXT, sensitivity TEXT, category TEXT)"
+        )
+        # fs table with the SELinux context split into columns as in `Inode`
+        self.cur.execute(
+            """CREATE VIEW IF NOT EXISTS fs_view AS
+            SELECT fs.rowid AS rowid,
+                   parent,
+                   name,
+                   ino,
+                   dev,
+                   nlink,
+                   uid,
+                   gid,
+                   size,
+                   atime,
+                   mtime,
+                   ctime,
+                   fs.type AS type,
+                   mode,
+                   context_id,
+                   path,
+                   dfs_enter,
+                   dfs_exit,
+                   object_contexts.user AS selinux_user,
+                   object_contexts.role AS selinux_role,
+                   object_contexts.type AS selinux_type,
+                   object_contexts.sensitivity AS selinux_sensitivity,
+                   object_contexts.category AS selinux_category
+            FROM fs
+            LEFT JOIN object_contexts ON context_id = object_contexts.rowid"""
         )
         self.cur.execute(
             "CREATE TABLE IF NOT EXISTS users(name TEXT, uid INTEGER PRIMARY KEY, gid INTEGER)"
@@ -984,6 +1623,10 @@ class DatabaseCreator(DatabaseWriter):
         self.cur.execute(
             "CREATE TABLE IF NOT EXISTS membership(uid INTEGER, gid INTEGER)"
         )
+        # Bitmaps indexed by rowid of the fs table, see `dac.DacEngine`
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS effective_access(uid INTEGER, permission INTEGER, bitmap BLOB, PRIMARY KEY (uid, permission))"
+        )
 
     def insert_dentry(
         self,
@@ -1000,18 +1643,19 @@ class DatabaseCreator(DatabaseWriter):
         ctime,
         _type,
         mode,
-        selinux_user,
-        selinux_role,
-        selinux_type,
-        selinux_sensitivity,
-        selinux_category,
+        context,
+        path,
     ):
         """Execute INSERT statement for a dentry.
 
+        :param context: SELinux context of the dentry as returned by
+        `os.getxattr`, or `None`.
+        :param path: full path of the dentry, starting with the name of the
+        root.
         :returns: rowid of inserted row
         """
         self.cur.execute(
-            'INSERT INTO fs VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            'INSERT INTO fs VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)',
             (
                 parent,
                 name,
@@ -1026,15 +1670,138 @@ class DatabaseCreator(DatabaseWriter):
                 ctime,
                 _type,
                 mode,
-                selinux_user,
-                selinux_role,
-                selinux_type,
-                selinux_sensitivity,
-                selinux_category,
+                self.get_object_context_id(context),
+                path,
             ),
         )
         return self.cur.lastrowid
 
+    def insert_dentries(self, dentries: Iterable[tuple]):
+        """Insert many dentries with rowids chosen by the caller.
+
+        Parents can be inserted in the same batch as their children, because
+        their rowids are known in advance. Depth-first numbers are left
+        `NULL`.
+
+        :param dentries: tuples of `Dentry` fields from `rowid` to `path`,
+        with `context_id` instead of a raw context.
+        """
+        self.cur.executemany(
+            f'''INSERT INTO fs (rowid, {FS_COLUMNS})
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)''',
+            dentries,
+        )
+
+    def get_next_rowid(self) -> int:
+        """Return rowid following the largest rowid in the fs table."""
+        return self.cur.execute(
+            'SELECT IFNULL(MAX(rowid), 0) + 1 FROM fs'
+        ).fetchone()[0]
+
+    def get_object_context_id(self, context: bytes | str | None) -> int | None:
+        """Return rowid of SELinux `context` in the object_contexts table.
+
+        The context is inserted if it isn't there yet. Rowids are cached by the
+        raw `context`, so it is decoded and split only once.
+
+        :param context: SELinux context as returned by `os.getxattr`, or as a
+        string.
+        """
+        if context is None:
+            return None
+        try:
+            return self._object_context_ids[context]
+        except KeyError:
+            pass
+        if isinstance(context, bytes):
+            text = context.rstrip(b'\x00').decode('utf-8')
+        else:
+            text = context
+        parts = text.split(':')
+        if len(parts) not in (4, 5):
+            raise ValueError(f'Invalid SELinux context {text!r}')
+        if len(parts) == 4:
+            parts.append(None)
+        self.cur.execute(
+            'INSERT INTO object_contexts VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING',
+            (text, *parts),
+        )
+        res = self.cur.execute(
+            'SELECT rowid FROM object_contexts WHERE context = ?', (text,)
+        )
+        rowid = res.fetchone()[0]
+        self._object_context_ids[context] = rowid
+        return rowid
+
+    def get_dentry_row(self, rowid: int) -> Dentry | None:
+        """Return row of the fs table with `rowid`."""
+        res = self.cur.execute(
+            'SELECT rowid, * FROM fs WHERE rowid = ?', (rowid,)
+        )
+        row = res.fetchone()
+        if row is None:
+            return None
+        return Dentry(*row)
+
+    def get_children_rows(self, parent_rowid: int) -> list[Dentry]:
+        """Return rows of the fs table inside directory `parent_rowid`."""
+        res = self.cur.execute(
+            'SELECT rowid, * FROM fs WHERE parent = ?', (parent_rowid,)
+        )
+        return [Dentry(*row) for row in res]
+
+    def update_dentry(self, rowid: int, *data):
+        """Replace metadata of the dentry with `rowid`.
+
+        :param data: the same values as for `insert_dentry` without `parent`
+        and `path`.
+        """
+        columns = ', '.join(f'{c} = ?' for c in Dentry._fields[2:-3])
+        *data, context = data
+        self.cur.execute(
+            f'UPDATE fs SET {columns} WHERE rowid = ?',
+            (*data, self.get_object_context_id(context), rowid),
+        )
+
+    def delete_subtrees(self, rowids: Iterable[int]):
+        """Delete dentries with `rowids` together with everything under them.
+
+        Accesses to deleted dentries are deleted together with their reference
+        and Medusa results.
+        """
+        self.cur.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS deleted(rowid INTEGER PRIMARY KEY)'
+        )
+        self.cur.execute('DELETE FROM temp.deleted')
+        self.cur.executemany(
+            'INSERT INTO temp.deleted VALUES(?)', ((r,) for r in rowids)
+        )
+        self.cur.execute(
+            '''INSERT OR IGNORE INTO temp.deleted
+               WITH RECURSIVE subtree(rowid) AS
+               (
+                 SELECT rowid FROM temp.deleted
+                 UNION ALL
+                 SELECT fs.rowid FROM fs JOIN subtree ON fs.parent = subtree.rowid
+               )
+               SELECT rowid FROM subtree'''
+        )
+        self.cur.execute(
+            '''DELETE FROM medusa_results WHERE result_id IN
+               (SELECT results.rowid FROM results
+                JOIN accesses ON results.access_id = accesses.rowid
+                WHERE node_rowid IN temp.deleted)'''
+        )
+        self.cur.execute(
+            '''DELETE FROM results WHERE access_id IN
+               (SELECT rowid FROM accesses WHERE node_rowid IN temp.deleted)'''
+        )
+        self.cur.execute(
+            'DELETE FROM accesses WHERE node_rowid IN temp.deleted'
+        )
+        self.cur.execute('DELETE FROM fs WHERE rowid IN temp.deleted')
+        self.path_cache.invalidate()
+
     def insert_unix_database(self):
         """Insert unix users and group information into the database.
 
@@ -1057,26 +1824,290 @@ class DatabaseCreator(DatabaseWriter):
                     (username,),
                 )
 
-    def close(self):
+    def checkpoint(self, frontier: Iterable[tuple[str, int, str]]):
+        """Commit inserted dentries together with the scan frontier.
+
+        :param frontier: `(directory, rowid, path)` of directories whose
+        contents haven't been inserted yet.
+        """
+        self.cur.execute(
+            'CREATE TABLE IF NOT EXISTS frontier(directory TEXT, parent INTEGER, path TEXT)'
+        )
+        self.cur.execute('DELETE FROM frontier')
+        self.cur.executemany('INSERT INTO frontier VALUES(?, ?, ?)', frontier)
         self.cur.execute('END TRANSACTION')
+        self.cur.execute('BEGIN TRANSACTION')
+
+    def get_frontier(self) -> list[tuple[str, int, str]] | None:
+        """Return the scan frontier stored by the last `checkpoint`.
+
+        :returns: `None` if there is no unfinished scan in the database.
+        """
+        res = self.cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'frontier'"
+        )
+        if res.fetchone() is None:
+            return None
+        res = self.cur.execute(
+            'SELECT directory, parent, path FROM frontier ORDER BY rowid'
+        )
+        return res.fetchall()
+
+    def drop_frontier(self):
+        """Mark the scan as finished."""
+        self.cur.execute('DROP TABLE IF EXISTS frontier')
+
+    def insert_effective_access(self, uid: int, permission: int, bitmap: bytes):
+        """Store effective access bitmap of `uid`, replacing the old one."""
+        self.cur.execute(
+            'INSERT OR REPLACE INTO effective_access VALUES(?, ?, ?)',
+            (uid, permission, bitmap),
+        )
+
+    def number_tree(self):
+        """Assign depth-first enter and exit numbers to every dentry.
+
+        `dfs_enter` numbers increase in a pre-order walk of the tree by
+        `DFS_SPACING` and `dfs_exit` is the largest `dfs_enter` inside the
+        subtree of a dentry, so the subtree of a directory is exactly the rows
+        with `dfs_enter` between its `dfs_enter` and `dfs_exit`. The gaps
+        between the numbers are used by `number_new_dentries`. Numbers of the
+        whole table are recomputed, which writes every row. Stored effective
+        access bitmaps are discarded.
+        """
+        # Children of every directory are listed using the index
         self.cur.execute(
             'CREATE INDEX IF NOT EXISTS parent_index ON fs (parent)'
         )
+        # Recreated by `close`, it would only slow down the update
+        self.cur.execute('DROP INDEX IF EXISTS fs_dfs_index')
+        # Computed from the old tree
+        self.cur.execute('DELETE FROM effective_access')
+        roots = self.cur.execute(
+            'SELECT rowid FROM fs WHERE parent IS NULL ORDER BY rowid'
+        ).fetchall()
+        self._number_subtrees([row[0] for row in roots], 0, DFS_SPACING)
+
+    def _number_subtrees(
+        self, roots: list[int], counter: int, spacing: int
+    ) -> int:
+        """Number subtrees of `roots` in depth-first order after `counter`.
+
+        :param spacing: difference of consecutive numbers.
+        :returns: the last assigned number.
+        """
+        update = 'UPDATE fs SET dfs_enter = ?, dfs_exit = ? WHERE rowid = ?'
+        numbers = []
+        # Rows waiting to be entered have `None` instead of their enter number
+        stack = [(rowid, None) for rowid in reversed(roots)]
+        while stack:
+            rowid, enter = stack.pop()
+            if enter is not None:
+                # Whole subtree has been numbered
+                numbers.append((enter, counter, rowid))
+                continue
+            counter += spacing
+            stack.append((rowid, counter))
+            res = self.cur.execute(
+                'SELECT rowid, type FROM fs WHERE parent = ?', (rowid,)
+            )
+            for child, _type in res.fetchall():
+                if _type == stat.S_IFDIR:
+                    stack.append((child, None))
+                else:
+                    counter += spacing
+                    numbers.append((counter, counter, child))
+            if len(numbers) >= 65536:
+                self.cur.executemany(update, numbers)
+                numbers = []
+        self.cur.executemany(update, numbers)
+        return counter
+
+    def _count_subtree_rows(self, rowids: list[int]) -> int:
+        """Return number of rows in subtrees of `rowids`."""
+        res = self.cur.execute(
+            f'''WITH RECURSIVE subtree(rowid) AS
+               (
+                 SELECT rowid FROM fs
+                 WHERE rowid IN ({", ".join("?" * len(rowids))})
+                 UNION ALL
+                 SELECT fs.rowid FROM fs JOIN subtree ON fs.parent = subtree.rowid
+               )
+               SELECT COUNT(*) FROM subtree''',
+            rowids,
+        )
+        return res.fetchone()[0]
+
+    def number_new_dentries(self) -> bool:
+        """Number dentries inserted into a tree numbered by `number_tree`.
+
+        New subtrees of a directory are numbered in the gap between its
+        `dfs_exit` and the next used number. `dfs_exit` of the directory and
+        of ancestors ending before the last new number is moved to it. Only
+        the new rows and the ancestors are written, numbers of deleted
+        dentries are just left unused. The whole tree is renumbered
+        by `number_tree` only if the new dentries of some directory don't
+        fit into its gap. Stored effective access bitmaps are discarded.
+
+        :returns: whether the whole tree was renumbered.
+        """
+        self.cur.execute('DELETE FROM effective_access')
+        # Highest new dentries, grouped by their numbered parent
+        res = self.cur.execute(
+            '''SELECT p.rowid, new.rowid
+               FROM fs AS new JOIN fs AS p ON p.rowid = new.parent
+               WHERE new.dfs_enter IS NULL AND p.dfs_enter IS NOT NULL
+               ORDER BY p.rowid, new.rowid'''
+        )
+        new_roots = {}
+        for parent, rowid in res.fetchall():
+            new_roots.setdefault(parent, []).append(rowid)
+        for parent, roots in new_roots.items():
+            # Numbering of a preceding directory may have moved `dfs_exit`
+            exit = self.get_subtree_range(parent)[1]
+            count = self._count_subtree_rows(roots)
+            res = self.cur.execute(
+                'SELECT MIN(dfs_enter) FROM fs WHERE dfs_enter > ?', (exit,)
+            )
+            following = res.fetchone()[0]
+            if following is None:
+                spacing = DFS_SPACING
+            else:
+                # Part of the gap is left for later updates
+                spacing = (following - exit - 1) // (count + 1)
+                if spacing < 1:
+                    self.number_tree()
+                    return True
+            last = self._number_subtrees(roots, exit, spacing)
+            # Ancestors ending before the new numbers, either with the
+            # subtree of `parent` or with a row deleted after it. Exits of
+            # ancestors never decrease going up.
+            rowid = parent
+            while rowid is not None:
+                row = self.cur.execute(
+                    'SELECT parent, dfs_exit FROM fs WHERE rowid = ?', (rowid,)
+                ).fetchone()
+                if row[1] >= last:
+                    break
+                self.cur.execute(
+                    'UPDATE fs SET dfs_exit = ? WHERE rowid = ?', (last, rowid)
+                )
+                rowid = row[0]
+        # Rows without a numbered ancestor, e.g. new roots
+        res = self.cur.execute(
+            'SELECT 1 FROM fs WHERE dfs_enter IS NULL LIMIT 1'
+        )
+        if res.fetchone() is not None:
+            self.number_tree()
+            return True
+        return False
+
+    def merge_shard(self, path: str, parent: int):
+        """Move dentries from a shard database at `path` under `parent`.
+
+        The shard has to be created by `DatabaseCreator`. Rows without parent
+        in the shard become children of `parent`, rowids of all other rows are
+        shifted past the rows already present in this database. SELinux
+        contexts are translated to rowids of this database.
+        """
+        columns = ', '.join(f'shard_fs.{c}' for c in Dentry._fields[2:-4])
+        self.cur.execute('END TRANSACTION')
+        self.cur.execute('ATTACH DATABASE ? AS shard', (path,))
+        self.cur.execute('BEGIN TRANSACTION')
         self.cur.execute(
-            'CREATE INDEX IF NOT EXISTS parent_name_index ON fs (parent, name)'
+            '''INSERT INTO object_contexts
+               SELECT * FROM shard.object_contexts WHERE true
+               ON CONFLICT DO NOTHING'''
         )
+        res = self.cur.execute('SELECT COALESCE(MAX(rowid), 0) FROM fs')
+        offset = res.fetchone()[0]
         self.cur.execute(
-            'CREATE INDEX IF NOT EXISTS selinux_type_index ON fs (selinux_type)'
+            f'''INSERT INTO fs (rowid, {FS_COLUMNS})
+               SELECT shard_fs.rowid + ?,
+                      COALESCE(shard_fs.parent + ?, ?),
+                      {columns},
+                      object_contexts.rowid,
+                      shard_fs.path,
+                      NULL,
+                      NULL
+               FROM shard.fs AS shard_fs
+               LEFT JOIN shard.object_contexts AS shard_contexts
+                 ON shard_fs.context_id = shard_contexts.rowid
+               LEFT JOIN object_contexts
+                 ON shard_contexts.context = object_contexts.context''',
+            (offset, offset, parent),
         )
+        self.cur.execute('END TRANSACTION')
+        self.cur.execute('DETACH DATABASE shard')
+        self.cur.execute('BEGIN TRANSACTION')
+
+    def close(self, indexes: bool = True):
+        """Commit and close the database file.
+
+        :param indexes: If `False`, don't create indexes on the fs table.
+        """
+        self.cur.execute('END TRANSACTION')
+        if self.resumable and not self.wal:
+            self.cur.execute('PRAGMA journal_mode = DELETE')
+        if indexes:
+            self.cur.execute(
+                'CREATE INDEX IF NOT EXISTS parent_index ON fs (parent)'
+            )
+            self.cur.execute(
+                'CREATE INDEX IF NOT EXISTS parent_name_index ON fs (parent, name)'
+            )
+            self.cur.execute(
+                'CREATE INDEX IF NOT EXISTS fs_context_index ON fs (context_id)'
+            )
+            self.cur.execute(
+                'CREATE INDEX IF NOT EXISTS object_context_type_index ON object_contexts (type)'
+            )
+            self.cur.execute(
+                'CREATE INDEX IF NOT EXISTS fs_dfs_index ON fs (dfs_enter)'
+            )
+            # Matching of entries between snapshots, see `diff.diff_snapshots`
+            self.cur.execute(
+                'CREATE INDEX IF NOT EXISTS fs_inode_index ON fs (dev, ino)'
+            )
         super().close()
 
 
 class DatabaseRead(DatabaseCommon):
     """Reading support from the database."""
 
-    def __init__(self, path):
-        self.con = sqlite3.connect(path)
+    def __init__(
+        self,
+        path,
+        path_cache_size: int = 65536,
+        readonly: bool = False,
+        immutable: bool = False,
+        mmap_size: int = 0,
+    ):
+        """Create `DatabaseRead`.
+
+        :param path_cache_size: maximum number of directories in the path
+        cache.
+        :param readonly: open the database with `mode=ro`. Such connection
+        can be passed between threads, but must be used by one thread at a
+        time.
+        :param immutable: open the database with `immutable=1`, which skips
+        all locking. Only for snapshots that are never written again.
+        :param mmap_size: maximum number of bytes of the database file read
+        through memory mapping, zero disables it.
+        """
+        if readonly or immutable:
+            uri = f'file:{quote(os.path.abspath(path))}?mode=ro'
+            if immutable:
+                uri += '&immutable=1'
+            self.con = sqlite3.connect(
+                uri, uri=True, check_same_thread=False
+            )
+        else:
+            self.con = sqlite3.connect(path)
         self.cur = self.con.cursor()
+        if mmap_size:
+            self.cur.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+        self.path_cache = PathCache(path_cache_size)
 
     def get_num_children(self, path: str) -> int:
         """Return number of items in folder at `path`."""
@@ -1130,6 +2161,12 @@ class DatabaseRead(DatabaseCommon):
             ino, uid, stat.S_IWUSR, stat.S_IWGRP, stat.S_IWOTH
         )
 
+    def can_execute(self, ino: Inode, uid: int) -> bool:
+        """Check if `ino` can be executed or searched by user with `uid`."""
+        return self._has_permission(
+            ino, uid, stat.S_IXUSR, stat.S_IXGRP, stat.S_IXOTH
+        )
+
     def get_reference_accesses(self, case: str, contexts: Iterable[str]):
         """
         :param case: Name of the case from which to retrieve accesses.
@@ -1140,41 +2177,13 @@ class DatabaseRead(DatabaseCommon):
         context_ids = [self.get_context_id(c) for c in contexts]
         expr = (f'subject_cid == "{c}"' for c in context_ids)
         ret = self.cur.execute(
-            f"""WITH RECURSIVE child AS
-  (SELECT accesses.case_id,
-          accesses.node_rowid,
-          accesses.subject_cid,
-          accesses.read,
-          accesses.write,
-          cases.name AS case_name,
-          contexts.name AS subject_context,
-          fs.rowid,
-          fs.parent,
-          fs.name
-   FROM accesses
-   JOIN cases ON case_id = cases.rowid
-   JOIN contexts ON subject_cid = contexts.rowid
-   JOIN fs ON node_rowid = fs.rowid
-   WHERE case_id = ?
-     AND ({" OR ".join(expr)})
-   UNION ALL SELECT case_id,
-                    node_rowid,
-                    subject_cid,
-                    READ,
-                    WRITE,
-                    case_name,
-                    subject_context,
-                    fs.rowid,
-                    fs.parent,
-                    fs.name || '/' || child.name
-   FROM fs,
-        child
-   WHERE child.parent = fs.rowid )
-SELECT name AS PATH,
-       READ,
-       WRITE
-FROM child
-WHERE rowid = 1""",
+            f"""SELECT fs.path AS PATH,
+       accesses.read AS READ,
+       accesses.write AS WRITE
+FROM accesses
+JOIN fs ON node_rowid = fs.rowid
+WHERE case_id = ?
+  AND ({" OR ".join(expr)})""",
             (case_id,),
         )
         return ret.fetchall()
@@ -1182,3 +2191,104 @@ WHERE rowid = 1""",
     def close(self):
         self.cur.close()
         self.con.close()
+
+
+class DatabaseReadPool:
+    """Thread-safe pool of read-only `DatabaseRead` connections.
+
+    Connections are opened on demand up to `size` and every one is used by a
+    single thread at a time, so queries of different threads run
+    concurrently. Databases written at the same time should be opened by
+    writers with `wal=True`, otherwise readers wait for every commit.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int = 4,
+        immutable: bool = False,
+        mmap_size: int = 1 << 28,
+        path_cache_size: int = 65536,
+    ):
+        """Create `DatabaseReadPool`.
+
+        :param size: maximum number of open connections.
+        :param immutable: open connections with `immutable=1`, see
+        `DatabaseRead`.
+        :param mmap_size: memory mapping limit of every connection.
+        :param path_cache_size: path cache size of every connection.
+        """
+        self.path = path
+        self.size = size
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.path_cache_size = path_cache_size
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _open(self) -> DatabaseRead | None:
+        """Open a new connection unless there are `size` of them already."""
+        with self._lock:
+            if len(self._connections) >= self.size:
+                return None
+            db = DatabaseRead(
+                self.path,
+                self.path_cache_size,
+                readonly=True,
+                immutable=self.immutable,
+                mmap_size=self.mmap_size,
+            )
+            self._connections.append(db)
+            return db
+
+    def acquire(self, timeout: float | None = None) -> DatabaseRead:
+        """Take a connection from the pool, waiting for one if all are in
+        use.
+
+        :raises queue.Empty: no connection was released within `timeout`
+        seconds.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        db = self._open()
+        if db is None:
+            db = self._idle.get(timeout=timeout)
+        return db
+
+    def release(self, db: DatabaseRead):
+        """Return a connection taken by `acquire` to the pool."""
+        self._idle.put(db)
+
+    @contextmanager
+    def connection(self, timeout: float | None = None) -> Iterator[DatabaseRead]:
+        """Context manager that acquires and releases a connection."""
+        db = self.acquire(timeout)
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def run(self, func: Callable, *args, **kwargs):
+        """Call `func` with a pooled connection as its first argument.
+
+        For example `pool.run(DatabaseRead.count_subtree, '/usr')`.
+        """
+        with self.connection() as db:
+            return func(db, *args, **kwargs)
+
+    def close(self):
+        """Close all connections, none of them may be in use."""
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections = []
+            self._idle = queue.LifoQueue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
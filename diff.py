@@ -0,0 +1,198 @@
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Differences between two snapshots of the same file system.
+
+Entries of both snapshots are matched by `dev`, `ino` and `type`. An entry
+at the same path is preferred, so hard links of one inode are paired by
+path. Matched entries are compared column by column. An entry is reported
+as moved only if its name or the inode of its parent directory changed, not
+when just one of its ancestors was moved or renamed. A file deleted
+between the snapshots whose inode number was reused by a new file looks
+like a moved and modified entry.
+
+Every difference is found by a query over both databases attached to one
+connection, which streams its rows through indexes on `(dev, ino)`, so
+memory use doesn't depend on the size of the snapshots. Both databases are
+only read.
+
+Usage: python3 -m fs2json.diff <old> <new> [options]
+"""
+import argparse
+import json
+import os
+import sqlite3
+from collections import namedtuple
+from collections.abc import Iterator
+from urllib.parse import quote
+from .fs2json import open_output
+
+# Columns compared by `modified` changes
+COMPARED_COLUMNS = ('mode', 'uid', 'gid', 'size', 'mtime')
+
+Change = namedtuple('Change', ['kind', 'old_path', 'new_path', 'columns'])
+Change.__doc__ = """Difference of a single entry.
+
+`kind` is one of `added`, `removed`, `moved`, `modified` or `relabeled`.
+An entry can have several changes, e.g. be both moved and modified.
+`columns` are the names of changed columns of a `modified` entry.
+"""
+
+
+def _same_inode(a: str, b: str) -> str:
+    return f'{b}.dev = {a}.dev AND {b}.ino = {a}.ino AND {b}.type = {a}.type'
+
+
+def _exact(a: str, other: str) -> str:
+    """Condition that entry `a` has an entry at the same path in table
+    `other`."""
+    return f'''EXISTS (SELECT 1 FROM {other} AS x
+                WHERE {_same_inode(a, 'x')} AND x.path = {a}.path)'''
+
+
+def _unpaired(table: str, other: str) -> str:
+    """Query of paths in `table` that aren't paired with an entry of
+    `other`."""
+    return f'''SELECT a.path FROM {table} AS a
+WHERE NOT {_exact('a', other)}
+  AND NOT EXISTS (SELECT 1 FROM {other} AS b
+                  WHERE {_same_inode('a', 'b')}
+                    AND NOT {_exact('b', table)})'''
+
+
+def _pairs(old: str, new: str) -> str:
+    """Query of pairs of entries at the same path, or of entries that have
+    no entry at the same path in the other snapshot.
+
+    :param old: table of `_inode_table` of the old snapshot.
+    :param new: table of `_inode_table` of the new snapshot.
+    """
+    if new == 'main.fs':
+        join = f"JOIN main.fs AS n ON {_same_inode('o', 'n')}"
+    else:
+        join = f'''JOIN {new} AS ni ON {_same_inode('o', 'ni')}
+JOIN main.fs AS n ON n.rowid = ni.rowid'''
+    return f'''SELECT o.path, n.path,
+       o.path != n.path
+         AND (o.name != n.name
+              OR op.dev IS NOT np.dev OR op.ino IS NOT np.ino),
+       {", ".join(f"o.{c} IS NOT n.{c}" for c in COMPARED_COLUMNS)},
+       oc.context IS NOT nc.context
+FROM old.fs AS o
+{join}
+LEFT JOIN old.fs AS op ON op.rowid = o.parent
+LEFT JOIN main.fs AS np ON np.rowid = n.parent
+LEFT JOIN old.object_contexts AS oc ON oc.rowid = o.context_id
+LEFT JOIN main.object_contexts AS nc ON nc.rowid = n.context_id
+WHERE o.path = n.path
+   OR (NOT {_exact('o', new)} AND NOT {_exact('n', old)})'''
+
+
+def _uri(path: str) -> str:
+    """Return URI opening the database at `path` read-only."""
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'database {path} does not exist')
+    return f'file:{quote(os.path.abspath(path))}?mode=ro'
+
+
+def _inode_table(con: sqlite3.Connection, schema: str) -> str:
+    """Return table with `rowid`, `dev`, `ino`, `type` and `path` of the
+    fs table in `schema` indexed by `(dev, ino)`."""
+    res = con.execute(
+        f'''SELECT 1 FROM {schema}.sqlite_master
+            WHERE type = 'index' AND name = 'fs_inode_index' '''
+    )
+    if res.fetchone() is not None:
+        return f'{schema}.fs'
+    # Databases created before the index was added to
+    # `DatabaseCreator.close` are indexed in the temporary database
+    con.execute(
+        f'''CREATE TEMP TABLE {schema}_inodes AS
+            SELECT rowid, dev, ino, type, path FROM {schema}.fs'''
+    )
+    con.execute(
+        f'CREATE INDEX temp.{schema}_inodes_index ON {schema}_inodes (dev, ino)'
+    )
+    return f'temp.{schema}_inodes'
+
+
+def _connect(old: str, new: str) -> sqlite3.Connection:
+    """Open `new` with `old` attached, both read-only."""
+    con = sqlite3.connect(_uri(new), uri=True)
+    con.execute('ATTACH DATABASE ? AS old', (_uri(old),))
+    # Sorting, automatic and temporary indexes spill to disk instead of
+    # memory
+    con.execute('PRAGMA temp_store = FILE')
+    return con
+
+
+def diff_snapshots(old: str, new: str) -> Iterator[Change]:
+    """Yield differences between databases `old` and `new` created by
+    `DatabaseCreator`.
+
+    Removed entries come first, then added entries and then changes of
+    entries present in both snapshots. Both databases are opened read-only,
+    `(dev, ino)` of a database without the index on them is copied to an
+    indexed temporary table.
+
+    :raises FileNotFoundError: if `old` or `new` doesn't exist.
+    """
+    con = _connect(old, new)
+    try:
+        old_inodes = _inode_table(con, 'old')
+        new_inodes = _inode_table(con, 'main')
+        res = con.execute(_unpaired(old_inodes, new_inodes))
+        for (path,) in res:
+            yield Change('removed', path, None, ())
+        res = con.execute(_unpaired(new_inodes, old_inodes))
+        for (path,) in res:
+            yield Change('added', None, path, ())
+        for old_path, new_path, moved, *changed, relabeled in con.execute(
+            _pairs(old_inodes, new_inodes)
+        ):
+            if moved:
+                yield Change('moved', old_path, new_path, ())
+            if any(changed):
+                columns = tuple(
+                    c for c, flag in zip(COMPARED_COLUMNS, changed) if flag
+                )
+                yield Change('modified', old_path, new_path, columns)
+            if relabeled:
+                yield Change('relabeled', old_path, new_path, ())
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('old', help='path of the older database')
+    parser.add_argument('new', help='path of the newer database')
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='''write one JSON object per change to this file instead of
+        standard output''',
+    )
+    parser.add_argument(
+        '-c',
+        '--compress',
+        choices=('auto', 'zstd', 'gzip', 'xz', 'none'),
+        default='auto',
+        help='''compression of the output, auto chooses it from the suffix of
+        the output file (default: %(default)s)''',
+    )
+    args = parser.parse_args()
+    with open_output(args.output, args.compress) as out:
+        for change in diff_snapshots(args.old, args.new):
+            out.write(json.dumps(change._asdict()) + '\n')
@@ -17,59 +17,134 @@
 from os import stat
 import os
 from stat import *
+import argparse
+import gzip
 import json
+import lzma
 import sys
+from typing import BinaryIO
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def get_json(filename, path):
-    s = stat(path, follow_symlinks=False)
-    r = {
-        'name': filename,
-        'ino': s.st_ino,
-        'dev': s.st_dev,
-        'nlink': s.st_nlink,
-        'uid': s.st_uid,
-        'gid': s.st_gid,
-        'size': s.st_size,
-        'atime': s.st_atime,
-        'mtime': s.st_mtime,
-        'ctime': s.st_ctime,
-        'ifsock': int(bool(S_ISSOCK(s.st_mode))),
-        'iflnk': int(bool(S_ISLNK(s.st_mode))),
-        'ifblk': int(bool(S_ISBLK(s.st_mode))),
-        'isreg': int(bool(S_ISREG(s.st_mode))),
-        'ifdir': int(bool(S_ISDIR(s.st_mode))),
-        'ifchr': int(bool(S_ISCHR(s.st_mode))),
-        'ififo': int(bool(S_ISFIFO(s.st_mode))),
-        'isuid': int(bool(s.st_mode & S_ISUID)),
-        'isgid': int(bool(s.st_mode & S_ISGID)),
-        'isvtx': int(bool(s.st_mode & S_ISVTX)),
-        'irusr': int(bool(s.st_mode & S_IRUSR)),
-        'iwusr': int(bool(s.st_mode & S_IWUSR)),
-        'ixusr': int(bool(s.st_mode & S_IXUSR)),
-        'irgrp': int(bool(s.st_mode & S_IRGRP)),
-        'iwgrp': int(bool(s.st_mode & S_IWGRP)),
-        'ixgrp': int(bool(s.st_mode & S_IXGRP)),
-        'iroth': int(bool(s.st_mode & S_IROTH)),
-        'iwoth': int(bool(s.st_mode & S_IWOTH)),
-        'ixoth': int(bool(s.st_mode & S_IXOTH)),
-        }
-    return (json.dumps(r),
+
+# Keys of the bit fields in the order in which they are printed
+_BIT_KEYS = (
+    'ifsock',
+    'iflnk',
+    'ifblk',
+    'isreg',
+    'ifdir',
+    'ifchr',
+    'ififo',
+    'isuid',
+    'isgid',
+    'isvtx',
+    'irusr',
+    'iwusr',
+    'ixusr',
+    'irgrp',
+    'iwgrp',
+    'ixgrp',
+    'iroth',
+    'iwoth',
+    'ixoth',
+)
+# Same output as `json.dumps` of a dict, but much cheaper to produce
+_JSON_FORMAT = (
+    '{{"name": {}, "ino": {}, "dev": {}, "nlink": {}, "uid": {}, "gid": {}, '
+    '"size": {}, "atime": {!r}, "mtime": {!r}, "ctime": {!r}, '
+    + ', '.join(f'"{key}": {{}}' for key in _BIT_KEYS)
+    + '}}'
+)
+
+
+def format_json(
+    filename, ino, dev, nlink, uid, gid, size, atime, mtime, ctime, mode
+) -> str:
+    """Return JSON object describing a dentry without children."""
+    fmt = S_IFMT(mode)
+    return _JSON_FORMAT.format(
+        json.dumps(filename),
+        ino,
+        dev,
+        nlink,
+        uid,
+        gid,
+        size,
+        atime,
+        mtime,
+        ctime,
+        int(fmt == S_IFSOCK),
+        int(fmt == S_IFLNK),
+        int(fmt == S_IFBLK),
+        int(fmt == S_IFREG),
+        int(fmt == S_IFDIR),
+        int(fmt == S_IFCHR),
+        int(fmt == S_IFIFO),
+        # S_ISUID is bit 11, S_IXOTH is bit 0
+        mode >> 11 & 1,
+        mode >> 10 & 1,
+        mode >> 9 & 1,
+        mode >> 8 & 1,
+        mode >> 7 & 1,
+        mode >> 6 & 1,
+        mode >> 5 & 1,
+        mode >> 4 & 1,
+        mode >> 3 & 1,
+        mode >> 2 & 1,
+        mode >> 1 & 1,
+        mode & 1,
+    )
+
+
+def get_json(filename, path, s=None):
+    if s is None:
+        s = stat(path, follow_symlinks=False)
+    info = format_json(
+        filename,
+        s.st_ino,
+        s.st_dev,
+        s.st_nlink,
+        s.st_uid,
+        s.st_gid,
+        s.st_size,
+        s.st_atime,
+        s.st_mtime,
+        s.st_ctime,
+        s.st_mode,
+    )
+    return (info,
             bool(S_ISDIR(s.st_mode)),
             bool(S_ISREG(s.st_mode)))
 
 
-def _walktree(top):
+def scan_directory(top):
+    """Yield `(name, path, stat_result)` for every entry of directory `top`.
+
+    Entries are streamed from `os.scandir`, so no list of names is built for
+    the directory. The path and `lstat` data come from the `DirEntry`, which
+    saves a separate `os.path.join` and path-based `stat` call per entry.
+    Entries that disappear or can't be stat'ed are skipped.
+    """
+    with os.scandir(top) as it:
+        for entry in it:
+            try:
+                s = entry.stat(follow_symlinks=False)
+            except (FileNotFoundError, PermissionError):
+                continue
+            yield entry.name, entry.path, s
+
+
+def _walktree(top, out):
     '''recursively descend the directory tree rooted at top,
        calling the callback function for each regular file'''
 
     i = 0
-    for f in os.listdir(top):
-        pathname = os.path.join(top, f)
-        try:
-            info, isdir, isreg = get_json(f, pathname)
-        except (FileNotFoundError, PermissionError):
-            continue
+    for f, pathname, s in scan_directory(top):
+        info, isdir, isreg = get_json(f, pathname, s)
 
         # Continuing output in children list needs a comma
         if i != 0:
@@ -79,29 +154,197 @@ def _walktree(top):
             # It's a directory, recurse into it
             # create children in json
             info = info[:-1] + ', "children": ['
-            print(info, end='')
-            _walktree(pathname)
+            out.write(info)
+            _walktree(pathname, out)
             # close children in json
-            print(']}', end='')
+            out.write(']}')
         else:
-            print(info, end='')
+            out.write(info)
         i += 1
 
 
-def walktree(root):
+def walktree(root, out=None):
+    """Write JSON structure of the tree rooted at `root` to `out`.
+
+    :param out: object with a `write` method accepting strings. Defaults to
+    standard output.
+    """
+    if out is None:
+        out = sys.stdout
     info, isdir, isreg = get_json(os.path.basename(os.path.normpath(root)), root)
     if isdir:
         # It's a directory, recurse into it
         # create children in json
         info = info[:-1] + ', "children": ['
-        print(info, end='')
-        _walktree(root)
+        out.write(info)
+        _walktree(root, out)
         # close children in json
-        print(']}', end='')
+        out.write(']}')
     else:
-        print(info, end='')
-    print()
+        out.write(info)
+    out.write('\n')
+
+
+def walktree_ndjson(root, out=None):
+    """Write the tree rooted at `root` to `out` as one JSON object per line.
+
+    Every object has an `id` and the `id` of its `parent` directory (`null`
+    for the root), which correspond to rowid and parent in the fs table of the
+    database. Unlike `walktree`, the output can be split at any line and
+    consumed without parsing the whole document.
+
+    :param out: object with a `write` method accepting strings. Defaults to
+    standard output.
+    """
+    if out is None:
+        out = sys.stdout
+    info, isdir, isreg = get_json(os.path.basename(os.path.normpath(root)), root)
+    out.write(f'{{"id": 1, "parent": null, {info[1:]}\n')
+    last_id = 1
+    # Directories waiting to be listed
+    frontier = [(root, last_id)] if isdir else []
+    while frontier:
+        top, parent = frontier.pop()
+        for f, pathname, s in scan_directory(top):
+            info, isdir, isreg = get_json(f, pathname, s)
+            last_id += 1
+            out.write(f'{{"id": {last_id}, "parent": {parent}, {info[1:]}\n')
+            if isdir:
+                frontier.append((pathname, last_id))
+
+
+class BufferedSink:
+    """Text sink that writes to a binary file in large chunks.
+
+    Strings are collected in a list and encoded and written at once when they
+    exceed `buffer_size` characters, which is much cheaper than a `print` call
+    for every entry.
+
+    :param raw: file underlying a compressor `f` that doesn't close it.
+    """
+
+    def __init__(
+        self,
+        f: BinaryIO,
+        raw: BinaryIO | None = None,
+        buffer_size: int = 1 << 22,
+    ):
+        self.f = f
+        self.raw = raw
+        self.buffer_size = buffer_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, s: str):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self._parts).encode('utf-8', 'surrogateescape'))
+        self._parts = []
+        self._size = 0
+
+    def close(self):
+        """Flush the buffer and close the underlying file."""
+        self.flush()
+        self.f.close()
+        if self.raw is not None:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+COMPRESSION_SUFFIXES = {'.zst': 'zstd', '.gz': 'gzip', '.xz': 'xz'}
+
+
+def open_output(
+    path: str | None, compress: str = 'auto', level: int | None = None
+) -> BufferedSink:
+    """Open a buffered, optionally compressed, output sink.
+
+    :param path: output file, `None` or `-` for standard output.
+    :param compress: one of `zstd`, `gzip`, `xz`, `none` or `auto`, which
+    chooses compression according to the suffix of `path`. Without the
+    `zstandard` module, `zstd` falls back to `xz` and the suffix of `path` is
+    changed accordingly.
+    :param level: compression level, default of the compressor if `None`.
+    """
+    if compress == 'auto':
+        suffix = os.path.splitext(path or '')[1]
+        compress = COMPRESSION_SUFFIXES.get(suffix, 'none')
+    if compress == 'zstd' and zstandard is None:
+        if path not in (None, '-') and path.endswith('.zst'):
+            path = path[: -len('.zst')] + '.xz'
+        target = '<stdout>' if path in (None, '-') else path
+        print(
+            f'zstandard module is not available, writing xz to {target}',
+            file=sys.stderr,
+        )
+        compress = 'xz'
+
+    if path in (None, '-'):
+        raw = open(sys.stdout.fileno(), 'wb', closefd=False)
+    else:
+        raw = open(path, 'wb')
+
+    if compress == 'zstd':
+        # Equivalent of `zstd -T0 --long`
+        params = zstandard.ZstdCompressionParameters.from_level(
+            3 if level is None else level,
+            threads=-1,
+            enable_ldm=True,
+            window_log=27,
+        )
+        compressor = zstandard.ZstdCompressor(compression_params=params)
+        return BufferedSink(compressor.stream_writer(raw))
+    elif compress == 'gzip':
+        f = gzip.GzipFile(
+            fileobj=raw, mode='wb', compresslevel=9 if level is None else level
+        )
+        return BufferedSink(f, raw)
+    elif compress == 'xz':
+        return BufferedSink(lzma.LZMAFile(raw, 'wb', preset=level), raw)
+    return BufferedSink(raw)
 
 
 if __name__ == '__main__':
-    walktree(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description='Print JSON structure of a file system.'
+    )
+    parser.add_argument('root', help='start at this directory')
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='write to this file instead of standard output',
+    )
+    parser.add_argument(
+        '-c',
+        '--compress',
+        choices=('auto', 'zstd', 'gzip', 'xz', 'none'),
+        default='auto',
+        help='''compression of the output, auto chooses it from the suffix of
+        the output file (default: %(default)s)''',
+    )
+    parser.add_argument(
+        '-l', '--level', type=int, help='compression level'
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=('json', 'ndjson'),
+        default='json',
+        help='''json prints one nested document, ndjson prints one object per
+        line with id and parent id (default: %(default)s)''',
+    )
+    args = parser.parse_args()
+    with open_output(args.output, args.compress, args.level) as out:
+        if args.format == 'ndjson':
+            walktree_ndjson(args.root, out)
+        else:
+            walktree(args.root, out)
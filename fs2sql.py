@@ -13,27 +13,35 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from os import stat, listdir
+from os import stat
 import os
 from stat import *
 import json
 import sys
-from .db import DatabaseCreator
+import queue
+import threading
+import tempfile
+import multiprocessing
+from collections import namedtuple
+from time import monotonic
+from .db import DatabaseCreator, Dentry
+from .fs2json import scan_directory
 
 
-def get_dentry(filename, path):
-    s = stat(path, follow_symlinks=False)
+UpdateStats = namedtuple(
+    'UpdateStats', ['skipped', 'rescanned', 'inserted', 'updated', 'deleted']
+)
+
+
+def get_dentry(filename, path, s=None):
+    if s is None:
+        s = stat(path, follow_symlinks=False)
     try:
-        selinux = os.getxattr(path, 'security.selinux').rstrip(b'\x00').decode('utf-8')
-        selinux = selinux.split(':')
-        if len(selinux) not in (4, 5):
-            print('Assertion failed:', selinux)
-            sys.exit(-1)
-        if len(selinux) == 4:
-            selinux.append(None)
+        # Raw value is decoded by the database only once for every context
+        context = os.getxattr(path, 'security.selinux')
     except OSError:
         # Operation not supported (/proc fs etc.)
-        selinux = [None] * 5
+        context = None
     data = (
         filename,
         s.st_ino,
@@ -47,34 +55,380 @@ def get_dentry(filename, path):
         s.st_ctime,
         S_IFMT(s.st_mode),
         S_IMODE(s.st_mode),
-        *selinux
+        context,
     )
     return (data, bool(S_ISDIR(s.st_mode)), bool(S_ISREG(s.st_mode)))
 
 
-def _walktree(top: str, parent: int, db: DatabaseCreator):
-    '''Recursively descend the directory tree rooted at top, inserting dentries
-    into the database.
+def _walktree(
+    frontier: list[tuple[str, int, str]],
+    db: DatabaseCreator,
+    checkpoint: float = 0,
+):
+    '''Descend the directory trees in `frontier`, inserting dentries into the
+    database.
+
+    Directories waiting to be scanned are kept in `frontier` as
+    `(directory, rowid, path)` instead of on the call stack, so the depth of
+    the tree is not limited by the recursion limit. `path` is the path of the
+    directory stored in the database.
+
+    :param checkpoint: if non-zero, commit the scan together with `frontier`
+    every `checkpoint` seconds, so it can be resumed by `resume_walktree`.
     '''
+    last_checkpoint = monotonic()
+    while frontier:
+        top, parent, path = frontier.pop()
+        for f, pathname, s in scan_directory(top):
+            data, isdir, isreg = get_dentry(f, pathname, s)
+
+            # Insert into database
+            new_path = f'{path}/{f}'
+            new_parent = db.insert_dentry(parent, *data, new_path)
+
+            if isdir:
+                frontier.append((pathname, new_parent, new_path))
 
-    for f in os.listdir(top):
-        pathname = os.path.join(top, f)
+        if checkpoint and monotonic() - last_checkpoint >= checkpoint:
+            db.checkpoint(frontier)
+            last_checkpoint = monotonic()
+
+
+def _scan_worker(
+    directories: queue.SimpleQueue,
+    results: queue.Queue,
+    batch_size: int,
+    stop: threading.Event,
+):
+    """Stat dentries of directories taken from `directories`.
+
+    Dentries are sent to `results` in batches of
+    `(parent, path, entries, done)` where `done` marks the last batch of a
+    directory. Exceptions are forwarded to `results` so the writer can re-raise
+    them. `None` or `stop` stops the worker.
+    """
+    while (item := directories.get()) is not None:
+        top, parent, path = item
         try:
-            data, isdir, isreg = get_dentry(f, pathname)
-        except (FileNotFoundError, PermissionError):
-            continue
+            entries = []
+            for f, pathname, s in scan_directory(top):
+                data, isdir, isreg = get_dentry(f, pathname, s)
+                entries.append((data, isdir, pathname))
+                if len(entries) == batch_size:
+                    results.put((parent, path, entries, False))
+                    entries = []
+                    if stop.is_set():
+                        return
+            results.put((parent, path, entries, True))
+            if stop.is_set():
+                return
+        except BaseException as e:
+            results.put(e)
+            return
 
-        # Insert into database
-        new_parent = db.insert_dentry(parent, *data)
 
-        if isdir:
-            _walktree(pathname, new_parent, db)
+def _walktree_threaded(
+    top: str,
+    parent: int,
+    path: str,
+    db: DatabaseCreator,
+    workers: int,
+    queue_size: int = 64,
+    batch_size: int = 1024,
+):
+    '''Descend the directory tree rooted at top using a pool of `workers`
+    threads.
 
+    Worker threads list and stat directories concurrently, while the calling
+    thread is the only writer to `db`. Rowids of inserted directories are
+    handed back to the workers together with the directory path, so `parent`
+    is always correct.
+    '''
+    directories = queue.SimpleQueue()
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=_scan_worker,
+            args=(directories, results, batch_size, stop),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for t in threads:
+        t.start()
 
-def walktree(root: str, db: DatabaseCreator):
-    data, isdir, isreg = get_dentry(
-        os.path.basename(os.path.normpath(root)), root
-    )
-    parent = db.insert_dentry(None, *data)
+    try:
+        directories.put((top, parent, path))
+        # Number of directories that haven't been completely inserted yet
+        pending = 1
+        while pending:
+            item = results.get()
+            if isinstance(item, BaseException):
+                raise item
+            parent, path, entries, done = item
+            for data, isdir, pathname in entries:
+                new_path = f'{path}/{data[0]}'
+                new_parent = db.insert_dentry(parent, *data, new_path)
+                if isdir:
+                    directories.put((pathname, new_parent, new_path))
+                    pending += 1
+            if done:
+                pending -= 1
+    finally:
+        # Workers are stopped also when the writer fails
+        stop.set()
+        for _ in threads:
+            directories.put(None)
+        for t in threads:
+            while t.is_alive():
+                # Workers blocked on a full `results` are released
+                try:
+                    results.get_nowait()
+                except queue.Empty:
+                    t.join(0.05)
+
+
+def _split_tree(
+    top: str,
+    parent: int,
+    path: str,
+    db: DatabaseCreator,
+    shards: int,
+    max_depth: int = 3,
+) -> list[tuple[str, int, str]]:
+    """Insert the top levels of the tree into `db` until there are at least
+    `shards` directories left to scan.
+
+    :returns: A list of `(directory, rowid, path)` of directories whose
+    contents haven't been scanned yet.
+    """
+    frontier = [(top, parent, path)]
+    for _ in range(max_depth):
+        if len(frontier) >= shards:
+            break
+        next_frontier = []
+        for top, parent, path in frontier:
+            for f, pathname, s in scan_directory(top):
+                data, isdir, isreg = get_dentry(f, pathname, s)
+                new_path = f'{path}/{f}'
+                new_parent = db.insert_dentry(parent, *data, new_path)
+                if isdir:
+                    next_frontier.append((pathname, new_parent, new_path))
+        frontier = next_frontier
+    return frontier
+
+
+def _scan_shard(args: tuple[int, str, str, str, int]) -> tuple[int, str]:
+    """Scan contents of a directory into a separate shard database.
+
+    Dentries directly inside the scanned directory have `NULL` parent in the
+    shard.
+    """
+    i, top, path, shard_path, workers = args
+    db = DatabaseCreator(shard_path, drop=True)
+    if workers > 1:
+        _walktree_threaded(top, None, path, db, workers)
+    else:
+        _walktree([(top, None, path)], db)
+    db.close(indexes=False)
+    return i, shard_path
+
+
+def _walktree_sharded(
+    top: str,
+    parent: int,
+    path: str,
+    db: DatabaseCreator,
+    processes: int,
+    workers: int = 1,
+    shard_dir: str | None = None,
+):
+    '''Descend the directory tree rooted at top using `processes` worker
+    processes.
+
+    Subtrees are scanned into temporary shard databases in `shard_dir`, which
+    are merged into `db` as soon as they are finished.
+    '''
+    shards = _split_tree(top, parent, path, db, processes * 4)
+    with tempfile.TemporaryDirectory(dir=shard_dir) as tmp:
+        tasks = [
+            (i, top, path, os.path.join(tmp, f'shard{i}.db'), workers)
+            for i, (top, _, path) in enumerate(shards)
+        ]
+        with multiprocessing.Pool(processes) as pool:
+            for i, shard_path in pool.imap_unordered(_scan_shard, tasks):
+                db.merge_shard(shard_path, shards[i][1])
+                os.remove(shard_path)
+
+
+def walktree(
+    root: str,
+    db: DatabaseCreator,
+    workers: int = 1,
+    processes: int = 1,
+    shard_dir: str | None = None,
+    checkpoint: float = 0,
+):
+    """Insert the directory tree rooted at `root` into `db`.
+
+    Dentries are inserted in a different order than when walking serially if
+    `workers` or `processes` is greater than one.
+
+    :param workers: number of threads that stat dentries.
+    :param processes: number of processes that scan subtrees into separate
+    shard databases. Every process uses `workers` threads.
+    :param shard_dir: directory for temporary shard databases.
+    :param checkpoint: interval in seconds between checkpoints of a serial
+    scan. `db` should be created with `resumable=True`. Zero disables
+    checkpoints.
+
+    Dentries are numbered by `DatabaseCreator.number_tree` when the scan is
+    finished.
+    """
+    # Path of the root in the database is its name, so a scan of `/` stores
+    # absolute paths
+    path = os.path.basename(os.path.normpath(root))
+    data, isdir, isreg = get_dentry(path, root)
+    parent = db.insert_dentry(None, *data, path)
     if isdir:
-        _walktree(root, parent, db)
+        if processes > 1:
+            _walktree_sharded(
+                root, parent, path, db, processes, workers, shard_dir
+            )
+        elif workers > 1:
+            _walktree_threaded(root, parent, path, db, workers)
+        else:
+            _walktree([(root, parent, path)], db, checkpoint)
+            db.drop_frontier()
+    db.number_tree()
+
+
+def resume_walktree(db: DatabaseCreator, checkpoint: float = 0) -> bool:
+    """Continue a serial scan from the last checkpoint stored in `db`.
+
+    :param checkpoint: interval in seconds between further checkpoints.
+    :returns: `False` if `db` doesn't contain a checkpoint to resume from.
+    """
+    frontier = db.get_frontier()
+    if frontier is None:
+        return False
+    _walktree(frontier, db, checkpoint)
+    db.drop_frontier()
+    db.number_tree()
+    return True
+
+
+def _same_dentry(data: tuple, stored: Dentry, db: DatabaseCreator) -> bool:
+    """Compare fresh dentry data with a row from the database.
+
+    Access time is ignored, because it changes just by scanning the tree.
+    """
+    (
+        name,
+        ino,
+        dev,
+        nlink,
+        uid,
+        gid,
+        size,
+        atime,
+        mtime,
+        ctime,
+        _type,
+        mode,
+        context,
+    ) = data
+    return (
+        name,
+        ino,
+        dev,
+        nlink,
+        uid,
+        gid,
+        size,
+        mtime,
+        ctime,
+        _type,
+        mode,
+        db.get_object_context_id(context),
+    ) == (
+        stored.name,
+        stored.ino,
+        stored.dev,
+        stored.nlink,
+        stored.uid,
+        stored.gid,
+        stored.size,
+        stored.mtime,
+        stored.ctime,
+        stored.type,
+        stored.mode,
+        stored.context_id,
+    )
+
+
+def updatetree(root: str, db: DatabaseCreator) -> UpdateStats:
+    """Update the fs table in `db` created by `walktree` from `root`.
+
+    Only directories whose `ino`, `mtime` or `ctime` changed are listed again.
+    Other directories are skipped, but their subdirectories are still checked.
+    Metadata changes of files inside skipped directories are therefore not
+    detected. Only inserted dentries are numbered by
+    `DatabaseCreator.number_new_dentries`, unless they don't fit between the
+    numbers of the existing tree.
+
+    :returns: Counts of skipped and rescanned directories and of inserted,
+    updated and deleted dentries (without their subtrees).
+    """
+    skipped = rescanned = inserted = updated = 0
+    deleted = []
+    frontier = [(root, 1)]
+    while frontier:
+        top, rowid = frontier.pop()
+        stored = db.get_dentry_row(rowid)
+        data, isdir, isreg = get_dentry(stored.name, top)
+        if not _same_dentry(data, stored, db):
+            db.update_dentry(rowid, *data)
+            updated += 1
+        # `ino`, `mtime` and `ctime` of the directory
+        if (data[1], data[8], data[9]) == (
+            stored.ino,
+            stored.mtime,
+            stored.ctime,
+        ):
+            skipped += 1
+            for child in db.get_children_rows(rowid):
+                if S_ISDIR(child.type):
+                    frontier.append(
+                        (os.path.join(top, child.name), child.rowid)
+                    )
+            continue
+
+        rescanned += 1
+        children = {child.name: child for child in db.get_children_rows(rowid)}
+        for f, pathname, s in scan_directory(top):
+            data, isdir, isreg = get_dentry(f, pathname, s)
+            child = children.pop(f, None)
+            if child is not None:
+                if (child.ino, child.type) == (data[1], data[10]):
+                    if isdir:
+                        # Directory compares itself to the stored row
+                        frontier.append((pathname, child.rowid))
+                    elif not _same_dentry(data, child, db):
+                        db.update_dentry(child.rowid, *data)
+                        updated += 1
+                    continue
+                # Dentry was replaced by a different inode
+                deleted.append(child.rowid)
+            new_path = f'{stored.path}/{f}'
+            new_parent = db.insert_dentry(rowid, *data, new_path)
+            inserted += 1
+            if isdir:
+                _walktree([(pathname, new_parent, new_path)], db)
+        deleted.extend(child.rowid for child in children.values())
+
+    db.delete_subtrees(deleted)
+    if inserted or updated or deleted:
+        db.number_new_dentries()
+    return UpdateStats(skipped, rescanned, inserted, updated, len(deleted))
@@ -15,14 +15,92 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from fs2json.db import DatabaseCreator
-from fs2json.fs2sql import walktree
+from fs2json.fs2sql import walktree, resume_walktree, updatetree
+import argparse
+import os
 import sys
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print(f'Usage: {sys.argv[0]} dir output_path')
-    db = DatabaseCreator(sys.argv[2], drop=True)
+    parser = argparse.ArgumentParser(
+        description='Store metadata of a directory tree in a sqlite database.'
+    )
+    parser.add_argument('dir', help='start at this directory')
+    parser.add_argument('output_path', help='path of the database file')
+    parser.add_argument(
+        '-j',
+        '--workers',
+        type=int,
+        default=1,
+        help='number of threads that stat files (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-p',
+        '--processes',
+        type=int,
+        default=1,
+        help='''number of processes that scan subtrees into temporary databases
+        next to output_path (default: %(default)s)''',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        type=float,
+        metavar='SECONDS',
+        help='''commit a serial scan every SECONDS so it can be resumed, 0
+        disables checkpoints (default: 300)''',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue an interrupted scan from its last checkpoint',
+    )
+    parser.add_argument(
+        '--update',
+        action='store_true',
+        help='''update an existing database, rescanning only directories that
+        changed since it was created''',
+    )
+    args = parser.parse_args()
+    serial = args.workers == 1 and args.processes == 1
+    if not serial and (args.resume or args.checkpoint or args.update):
+        parser.error('--checkpoint, --resume and --update require a serial scan')
+    if args.update and args.resume:
+        parser.error('--update and --resume are mutually exclusive')
+
+    if args.update:
+        db = DatabaseCreator(args.output_path)
+        stats = updatetree(args.dir, db)
+        db.close()
+        print(
+            f'''directories skipped={stats.skipped} rescanned={stats.rescanned}
+dentries inserted={stats.inserted} updated={stats.updated} deleted={stats.deleted}'''
+        )
+        sys.exit(0)
+    if args.checkpoint is None:
+        args.checkpoint = 300 if serial else 0
+
+    if args.resume:
+        db = DatabaseCreator(args.output_path, resumable=True)
+        if not resume_walktree(db, checkpoint=args.checkpoint):
+            db.close()
+            print(
+                f'No checkpoint found in {args.output_path}, start a new scan.',
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        db.close()
+        sys.exit(0)
+
+    db = DatabaseCreator(
+        args.output_path, drop=True, resumable=bool(args.checkpoint)
+    )
     db.insert_unix_database()
-    walktree(sys.argv[1], db)
+    walktree(
+        args.dir,
+        db,
+        workers=args.workers,
+        processes=args.processes,
+        shard_dir=os.path.dirname(os.path.abspath(args.output_path)),
+        checkpoint=args.checkpoint,
+    )
     db.close()
@@ -23,10 +23,14 @@ try:
         selinux_opt,
         selabel_close,
         context_free,
-        getfilecon
+        getfilecon,
     )
 except ImportError:
     pass
+from collections import namedtuple, OrderedDict
+from collections.abc import Iterable
+import hashlib
+import os
 import sys
 
 
@@ -56,26 +60,133 @@ def selinux_check_access(scon, tcon, tclass, perm):
     return code.get(ret, 0)
 
 
-def selinux_label_lookup(path: str, mode: int) -> str | None:
+def selinux_policy_hash() -> str | None:
+    """Return SHA-256 hash of the policy loaded in the kernel.
+
+    The kernel policy includes current values of booleans. The binary policy
+    file of the system doesn't, so it isn't used instead: decisions stored
+    under its hash would be wrong after `setsebool`.
+
+    :returns: `None` if the kernel policy can't be read.
     """
-    :param path: Path of the file which to look up.
-    :param mode: mode of `path as returned by lstat.
-    `"""
-    handle = selabel_open(SELABEL_CTX_FILE, None, 0)
-    # context is a list
     try:
-        context = selabel_lookup(handle, path, mode)
-    except FileNotFoundError:
-        # This is weird. Happens for paths such as `/proc/meminfo`. Let's try
-        # again, this time getting the information right from the filesystem
-        #
-        # `context` is a list [return value, actual context]
+        with open('/sys/fs/selinux/policy', 'rb') as f:
+            h = hashlib.sha256()
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+            return h.hexdigest()
+    except OSError:
+        return None
+
+
+# Statistics of `SelinuxLabeler` in the style of `functools.lru_cache`
+LabelCacheInfo = namedtuple(
+    'LabelCacheInfo', ['hits', 'misses', 'maxsize', 'currsize']
+)
+
+
+class SelinuxLabeler:
+    """Label lookup with a file contexts handle that is opened just once.
+
+    Looked up labels are kept in a bounded LRU cache keyed by `(path, mode)`.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._handle = None
+        self._labels = OrderedDict()
+
+    def _lookup(self, path: str, mode: int) -> str | None:
+        if self._handle is None:
+            # Parses file_contexts specification
+            self._handle = selabel_open(SELABEL_CTX_FILE, None, 0)
+        # context is a list
         try:
-            context = getfilecon(path)
+            context = selabel_lookup(self._handle, path, mode)
         except FileNotFoundError:
-            print(f"Can't get context for {path}.", file=sys.stderr)
-            return None
-        selabel_close(handle)
+            # This is weird. Happens for paths such as `/proc/meminfo`. Let's
+            # try again, this time getting the information right from the
+            # filesystem
+            #
+            # `context` is a list [return value, actual context]
+            try:
+                context = getfilecon(path)
+            except FileNotFoundError:
+                print(f"Can't get context for {path}.", file=sys.stderr)
+                return None
         return context[1]
-    selabel_close(handle)
-    return context[1]
+
+    def lookup(self, path: str, mode: int) -> str | None:
+        """
+        :param path: Path of the file which to look up.
+        :param mode: mode of `path` as returned by lstat.
+        """
+        key = (path, mode)
+        if key in self._labels:
+            self.hits += 1
+            self._labels.move_to_end(key)
+            return self._labels[key]
+        self.misses += 1
+        context = self._lookup(path, mode)
+        self._labels[key] = context
+        if len(self._labels) > self.maxsize:
+            self._labels.popitem(last=False)
+        return context
+
+    def lookup_many(
+        self, paths_and_modes: Iterable[tuple[str, int]]
+    ) -> list[str | None]:
+        """Return labels of `(path, mode)` pairs in input order.
+
+        Every distinct pair is looked up just once.
+        """
+        return [self.lookup(path, mode) for path, mode in paths_and_modes]
+
+    def info(self) -> LabelCacheInfo:
+        return LabelCacheInfo(
+            self.hits, self.misses, self.maxsize, len(self._labels)
+        )
+
+    def close(self):
+        """Close the handle, it is opened again by the next lookup."""
+        if self._handle is not None:
+            selabel_close(self._handle)
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Labeler of the current process and its pid, handles are not shared with
+# forked children
+_labeler = None
+_labeler_pid = None
+
+
+def get_labeler() -> SelinuxLabeler:
+    """Return `SelinuxLabeler` shared by the current process."""
+    global _labeler, _labeler_pid
+    if _labeler is None or _labeler_pid != os.getpid():
+        _labeler = SelinuxLabeler()
+        _labeler_pid = os.getpid()
+    return _labeler
+
+
+def selinux_label_lookup(path: str, mode: int) -> str | None:
+    """
+    :param path: Path of the file which to look up.
+    :param mode: mode of `path as returned by lstat.
+    `"""
+    return get_labeler().lookup(path, mode)
+
+
+def selinux_label_lookup_many(
+    paths_and_modes: Iterable[tuple[str, int]]
+) -> list[str | None]:
+    """Batch version of `selinux_label_lookup`."""
+    return get_labeler().lookup_many(paths_and_modes)
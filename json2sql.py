@@ -0,0 +1,347 @@
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Import fs2json output into the fs table.
+
+Both the nested document and the NDJSON output of `fs2json.py` are read as a
+stream, so memory use doesn't depend on the size of the document. SELinux
+contexts aren't part of the output, so `context_id` of imported dentries is
+`NULL`.
+
+Usage: python3 -m fs2json.json2sql <input> <output_path>
+"""
+import argparse
+import functools
+import gzip
+import io
+import json
+import lzma
+import re
+import sys
+from collections.abc import Iterator
+from stat import *
+from typing import TextIO
+from .db import DatabaseCreator
+from .fs2json import _BIT_KEYS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File type of every `if*` key and mode bit of every `is*`/`i[rwx]*` key
+_TYPES = (S_IFSOCK, S_IFLNK, S_IFBLK, S_IFREG, S_IFDIR, S_IFCHR, S_IFIFO)
+_NUMBER_KEYS = (
+    'ino', 'dev', 'nlink', 'uid', 'gid', 'size', 'atime', 'mtime', 'ctime'
+)
+# One token of the nested document: the end of a directory or a dentry,
+# optionally preceded by a separator of siblings, up to its closing brace or
+# its list of children. Keys are always printed in the same order, which the
+# regex relies on.
+_TOKEN = re.compile(
+    r'\]\}|(?:, )?\{"name": ("(?:[^"\\]|\\.)*"), '
+    + ', '.join(f'"{key}": ([-+.\\deE]+)' for key in _NUMBER_KEYS)
+    + ', ('
+    + ', '.join(f'"{key}": [01]' for key in _BIT_KEYS)
+    + r')(\}|, "children": \[)'
+)
+# Longest text that has to be buffered to match a single token
+_MAX_TOKEN = 1 << 16
+
+
+def open_input(path: str) -> TextIO:
+    """Open fs2json output, decompressing it according to the suffix.
+
+    :param path: input file, `-` for uncompressed standard input.
+    """
+    if path == '-':
+        f = open(sys.stdin.fileno(), 'rb', closefd=False)
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f'zstandard module is needed to read {path}')
+        # `zstd --long` uses windows larger than the default limit
+        reader = zstandard.ZstdDecompressor(
+            max_window_size=1 << 31
+        ).stream_reader(open(path, 'rb'), closefd=True)
+        f = io.BufferedReader(reader, 1 << 20)
+    elif path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    elif path.endswith('.xz'):
+        f = lzma.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    return io.TextIOWrapper(f, encoding='utf-8', errors='surrogateescape')
+
+
+@functools.cache
+def _mode(bits: tuple[int, ...]) -> tuple[int, int]:
+    """Return `type` and `mode` from values of the `_BIT_KEYS` fields."""
+    _type = 0
+    for value, file_type in zip(bits, _TYPES):
+        if value:
+            _type = file_type
+            break
+    # S_ISUID is the first of the 12 mode bits
+    mode = 0
+    for value in bits[len(_TYPES) :]:
+        mode = mode << 1 | value
+    return _type, mode
+
+
+@functools.cache
+def _bit_fields(text: str) -> tuple[int, int]:
+    """Return `type` and `mode` from the text of the `_BIT_KEYS` fields."""
+    return _mode(tuple(int(value) for value in re.findall(r': ([01])', text)))
+
+
+def iter_nested(f: TextIO, chunk_size: int = 1 << 20) -> Iterator[tuple | None]:
+    """Parse the nested fs2json document from `f`.
+
+    :returns: Iterator over dentries in document order as tuples of `name`,
+    `ino`, `dev`, `nlink`, `uid`, `gid`, `size`, `atime`, `mtime`, `ctime`,
+    `type`, `mode` and whether its children follow. The end of the list of
+    children is marked by `None`.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        match = _TOKEN.match(buf, pos)
+        if match is None or (match.end() == len(buf) and not eof):
+            # The token may continue in the next chunk
+            if eof:
+                if buf[pos:].strip():
+                    raise ValueError(f'unexpected data: {buf[pos:pos + 80]!r}')
+                return
+            if len(buf) - pos > _MAX_TOKEN:
+                raise ValueError(f'unexpected data: {buf[pos:pos + 80]!r}')
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        pos = match.end()
+        if match.group() == ']}':
+            yield None
+            continue
+        (
+            name,
+            ino,
+            dev,
+            nlink,
+            uid,
+            gid,
+            size,
+            atime,
+            mtime,
+            ctime,
+            bits,
+            end,
+        ) = match.groups()
+        # There are only a few distinct combinations of the bit fields
+        _type, mode = _bit_fields(bits)
+        yield (
+            json.loads(name) if '\\' in name else name[1:-1],
+            int(ino),
+            int(dev),
+            int(nlink),
+            int(uid),
+            int(gid),
+            int(size),
+            float(atime),
+            float(mtime),
+            float(ctime),
+            _type,
+            mode,
+            end != '}',
+        )
+
+
+def import_nested(
+    f: TextIO, db: DatabaseCreator, batch_size: int = 65536
+) -> int:
+    """Insert dentries of the nested fs2json document in `f` into `db`.
+
+    Rowids follow the rows already in `db`. Only the rowids and paths of
+    directories on the current path are kept in memory.
+
+    :returns: number of inserted dentries.
+    """
+    rowid = first = db.get_next_rowid()
+    # (rowid, path) of the directories whose children are being read
+    stack = []
+    batch = []
+    for dentry in iter_nested(f):
+        if dentry is None:
+            stack.pop()
+            continue
+        name, *data, has_children = dentry
+        if stack:
+            parent, parent_path = stack[-1]
+            path = f'{parent_path}/{name}'
+        else:
+            parent, path = None, name
+        batch.append((rowid, parent, name, *data, None, path))
+        if has_children:
+            stack.append((rowid, path))
+        rowid += 1
+        if len(batch) == batch_size:
+            db.insert_dentries(batch)
+            batch = []
+    db.insert_dentries(batch)
+    return rowid - first
+
+
+def import_ndjson(
+    f: TextIO, db: DatabaseCreator, batch_size: int = 65536
+) -> int:
+    """Insert dentries of the NDJSON fs2json output in `f` into `db`.
+
+    Ids of dentries are shifted past the rows already in `db`.
+    `fs2json.walktree_ndjson` lists all children of a directory at once and
+    takes directories from a stack, so only the paths of directories on the
+    same stack are kept in memory.
+
+    :raises ValueError: if children of a directory aren't listed in this
+    order.
+    :returns: number of inserted dentries.
+    """
+    offset = db.get_next_rowid() - 1
+    # (id, path) of directories whose children haven't been listed yet
+    pending = []
+    # (id, path) of the directory whose children are being read
+    current = None
+    batch = []
+    count = 0
+    for line in f:
+        if not line.strip():
+            continue
+        d = json.loads(line)
+        _type, mode = _mode(tuple(d[key] for key in _BIT_KEYS))
+        if d['parent'] is None:
+            parent, path = None, d['name']
+        else:
+            if current is None or current[0] != d['parent']:
+                # Directories above the parent on the stack are empty
+                current = None
+                while pending:
+                    directory = pending.pop()
+                    if directory[0] == d['parent']:
+                        current = directory
+                        break
+                if current is None:
+                    raise ValueError(
+                        f"parent {d['parent']} of dentry {d['id']} is not a "
+                        'directory waiting to be listed'
+                    )
+            parent = d['parent'] + offset
+            path = f"{current[1]}/{d['name']}"
+        if _type == S_IFDIR:
+            pending.append((d['id'], path))
+        batch.append(
+            (
+                d['id'] + offset,
+                parent,
+                d['name'],
+                *(d[key] for key in _NUMBER_KEYS),
+                _type,
+                mode,
+                None,
+                path,
+            )
+        )
+        count += 1
+        if len(batch) == batch_size:
+            db.insert_dentries(batch)
+            batch = []
+    db.insert_dentries(batch)
+    return count
+
+
+class _Prefixed:
+    """Text file `f` with already read `prefix` put back before it."""
+
+    def __init__(self, prefix: str, f: TextIO):
+        self._prefix = prefix
+        self._f = f
+
+    def read(self, size: int = -1) -> str:
+        if self._prefix:
+            text, self._prefix = self._prefix, ''
+            return text
+        return self._f.read(size)
+
+    def __iter__(self) -> Iterator[str]:
+        if self._prefix:
+            text, self._prefix = self._prefix, ''
+            yield text + self._f.readline()
+        yield from self._f
+
+
+def _detect_format(f: TextIO) -> tuple[str, _Prefixed]:
+    """Recognize the format of fs2json output from its first key.
+
+    :returns: `json` or `ndjson` and `f` with the read text without leading
+    whitespace put back.
+    """
+    prefix = ''
+    # Reads from pipes and decompressors may return less than requested
+    while len(prefix.lstrip()) < len('{"id"'):
+        text = f.read(len('{"id"'))
+        if not text:
+            break
+        prefix += text
+    fmt = 'ndjson' if prefix.lstrip().startswith('{"id"') else 'json'
+    return fmt, _Prefixed(prefix.lstrip(), f)
+
+
+def import_json(f: TextIO, db: DatabaseCreator, fmt: str = 'auto') -> int:
+    """Insert fs2json output from `f` into `db` and number the tree.
+
+    :param fmt: `json` for the nested document, `ndjson` or `auto`, which
+    recognizes the format from the first key of the output.
+    :returns: number of inserted dentries.
+    """
+    if fmt == 'auto':
+        fmt, f = _detect_format(f)
+    if fmt == 'ndjson':
+        count = import_ndjson(f, db)
+    else:
+        count = import_nested(f, db)
+    db.number_tree()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'input',
+        help='''fs2json output, optionally compressed (.zst, .gz, .xz), - for
+        standard input''',
+    )
+    parser.add_argument('output_path', help='path of the database file')
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=('auto', 'json', 'ndjson'),
+        default='auto',
+        help='''format of the input, auto recognizes it from its first bytes
+        (default: %(default)s)''',
+    )
+    args = parser.parse_args()
+    db = DatabaseCreator(args.output_path, drop=True)
+    with open_input(args.input) as f:
+        count = import_json(f, db, args.format)
+    db.close()
+    print(f'imported {count} dentries')
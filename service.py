@@ -0,0 +1,424 @@
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Query service that keeps a snapshot open for other processes.
+
+The daemon listens on a Unix domain socket and speaks JSON lines. Every
+request is an object `{"id": 1, "method": "search_path", "args": ["/usr"],
+"kwargs": {}}` and is answered by `{"id": 1, "result": ...}` or
+`{"id": 1, "error": {"type": "ValueError", "message": "..."}}`. Requests of
+one connection are executed concurrently by a pool of read connections, so
+responses may come in a different order than the requests.
+
+Usage: python3 -m fs2json.service <database> <socket> [options]
+"""
+import argparse
+import asyncio
+import builtins
+import json
+import os
+import signal
+import socket
+import stat
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from .db import DatabaseReadPool, Inode
+
+# `DatabaseRead` methods available to clients
+METHODS = frozenset(
+    {
+        'search_path',
+        'is_directory',
+        'get_children_inodes',
+        'get_num_children',
+        'get_owner',
+        'get_rowid',
+        'get_inode',
+        'get_children',
+        'get_subtree_range',
+        'is_in_subtree',
+        'count_subtree',
+        'count_subtree_accesses',
+        'can_read',
+        'can_write',
+        'can_execute',
+        'has_effective_access',
+    }
+)
+# Methods whose first argument is an `Inode`, which is sent as a list
+_INODE_ARGUMENT = frozenset({'can_read', 'can_write', 'can_execute'})
+
+
+def _execute(pool: DatabaseReadPool, request: dict):
+    method = request['method']
+    if method not in METHODS:
+        raise AttributeError(f'unknown method {method}')
+    args = request.get('args', [])
+    if method in _INODE_ARGUMENT and args:
+        args = [Inode(*args[0]), *args[1:]]
+    with pool.connection() as db:
+        result = getattr(db, method)(*args, **request.get('kwargs', {}))
+    # Missing paths are an empty tuple, which would become an empty list
+    return None if result == () else result
+
+
+async def _respond(
+    request: dict,
+    writer: asyncio.StreamWriter,
+    pool: DatabaseReadPool,
+    executor: ThreadPoolExecutor,
+    in_flight: asyncio.Semaphore,
+):
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            executor, _execute, pool, request
+        )
+        response = {'id': request.get('id'), 'result': result}
+    except Exception as e:
+        response = {
+            'id': request.get('id'),
+            'error': {'type': type(e).__name__, 'message': str(e)},
+        }
+    finally:
+        in_flight.release()
+    writer.write(json.dumps(response).encode() + b'\n')
+    await writer.drain()
+
+
+async def _handle_client(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    pool: DatabaseReadPool,
+    executor: ThreadPoolExecutor,
+    pipeline: int,
+):
+    """Answer requests of one client until it closes the connection.
+
+    At most `pipeline` requests are executed at once, further lines are not
+    read until some of them are answered.
+    """
+    in_flight = asyncio.Semaphore(pipeline)
+    tasks = set()
+    try:
+        while line := await reader.readline():
+            await in_flight.acquire()
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request is not a JSON object')
+            except ValueError as e:
+                in_flight.release()
+                writer.write(
+                    json.dumps(
+                        {
+                            'id': None,
+                            'error': {'type': 'ValueError', 'message': str(e)},
+                        }
+                    ).encode()
+                    + b'\n'
+                )
+                continue
+            task = asyncio.create_task(
+                _respond(request, writer, pool, executor, in_flight)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    except ConnectionError:
+        pass
+    finally:
+        # Requests still executed when the service stops
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+
+def _remove_stale_socket(path: str):
+    """Remove the socket at `path` left by a service that isn't running.
+
+    :raises FileExistsError: if `path` isn't a socket or a service is still
+    listening on it.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f'{path} exists and is not a socket')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise FileExistsError(f'a service is already listening on {path}')
+
+
+async def serve(
+    database: str,
+    path: str,
+    workers: int = 4,
+    pipeline: int = 256,
+    immutable: bool = False,
+    mmap_size: int = 1 << 28,
+):
+    """Answer queries on the Unix socket `path` until cancelled or
+    terminated.
+
+    :param workers: number of threads and read connections.
+    :param pipeline: maximum number of requests of a single client executed
+    at once.
+    :param immutable: open `database` with `immutable=1`, see `DatabaseRead`.
+    :raises FileExistsError: if `path` exists and isn't a socket left by a
+    service that has stopped.
+    """
+    _remove_stale_socket(path)
+    with DatabaseReadPool(
+        database, workers, immutable, mmap_size
+    ) as pool, ThreadPoolExecutor(workers) as executor:
+        clients = set()
+
+        def connected(reader, writer):
+            task = asyncio.create_task(
+                _handle_client(reader, writer, pool, executor, pipeline)
+            )
+            clients.add(task)
+            task.add_done_callback(clients.discard)
+
+        server = await asyncio.start_unix_server(connected, path)
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.cancel)
+        try:
+            async with server:
+                try:
+                    await stop
+                except asyncio.CancelledError:
+                    pass
+                # Connected clients would be cancelled by `asyncio.run`
+                # with a traceback
+                for task in clients:
+                    task.cancel()
+                await asyncio.gather(*clients, return_exceptions=True)
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            os.remove(path)
+
+
+def _error(error: dict) -> Exception:
+    """Re-create an exception raised by the service."""
+    cls = getattr(builtins, error['type'], None)
+    if isinstance(cls, type) and issubclass(cls, Exception):
+        return cls(error['message'])
+    return RuntimeError(f"{error['type']}: {error['message']}")
+
+
+def _inodes(rows: list | None) -> Inode | list[Inode] | tuple:
+    """Convert result of `search_path` back to `Inode`s."""
+    if rows is None:
+        # Path doesn't exist
+        return tuple()
+    if rows and isinstance(rows[0], list):
+        return [Inode(*row) for row in rows]
+    return Inode(*rows) if rows else []
+
+
+class Client:
+    """Synchronous client of the query service.
+
+    Methods have the same names, arguments and results as in `DatabaseRead`.
+    Many queries can be sent at once by `call_many`.
+    """
+
+    def __init__(self, path: str, window: int = 128):
+        """Connect to the service listening on `path`.
+
+        :param window: number of requests sent by `call_many` before their
+        responses are read, it shouldn't exceed `pipeline` of the service.
+        """
+        self.window = window
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._responses = self._sock.makefile('rb')
+        self._last_id = 0
+
+    def call_many(
+        self, calls: Iterable[tuple[str, tuple] | tuple[str, tuple, dict]]
+    ) -> list:
+        """Execute `(method, args[, kwargs])` calls and return their raw JSON
+        results in the same order.
+
+        Requests are pipelined, so round trips aren't paid for every call.
+        The first error is raised once all responses of its window are
+        received.
+        """
+        results = []
+        error = None
+        calls = iter(calls)
+        while True:
+            batch = {}
+            lines = []
+            for method, args, *kwargs in calls:
+                self._last_id += 1
+                batch[self._last_id] = len(results) + len(batch)
+                request = {'id': self._last_id, 'method': method, 'args': args}
+                if kwargs:
+                    request['kwargs'] = kwargs[0]
+                lines.append(json.dumps(request))
+                if len(batch) == self.window:
+                    break
+            if not batch:
+                return results
+            self._sock.sendall(('\n'.join(lines) + '\n').encode())
+            results.extend([None] * len(batch))
+            for _ in range(len(batch)):
+                line = self._responses.readline()
+                if not line:
+                    raise ConnectionError('service closed the connection')
+                response = json.loads(line)
+                if 'error' in response:
+                    if response['id'] not in batch:
+                        raise _error(response['error'])
+                    error = error or _error(response['error'])
+                    continue
+                results[batch[response['id']]] = response['result']
+            if error is not None:
+                raise error
+
+    def call(self, method: str, *args, **kwargs):
+        """Execute a single method and return its raw JSON result."""
+        return self.call_many([(method, args, kwargs)])[0]
+
+    def search_path(
+        self, path: str, children: bool = False, number: bool = False
+    ) -> tuple | Inode | list[Inode] | int:
+        result = self.call('search_path', path, children, number)
+        if children and number:
+            return tuple() if result is None else result
+        return _inodes(result)
+
+    def is_directory(self, path: str) -> bool:
+        return self.call('is_directory', path)
+
+    def get_children_inodes(self, path: str) -> list[Inode]:
+        return _inodes(self.call('get_children_inodes', path))
+
+    def get_num_children(self, path: str) -> int:
+        result = self.call('get_num_children', path)
+        return tuple() if result is None else result
+
+    def get_owner(self, path: str) -> int:
+        return self.call('get_owner', path)
+
+    def get_rowid(self, path: str) -> int | None:
+        return self.call('get_rowid', path)
+
+    def get_inode(self, rowid: int) -> Inode | None:
+        result = self.call('get_inode', rowid)
+        return Inode(*result) if result is not None else None
+
+    def get_children(self, parent_rowid: int) -> list[tuple[int, Inode]]:
+        return [
+            (rowid, Inode(*row))
+            for rowid, row in self.call('get_children', parent_rowid)
+        ]
+
+    def get_subtree_range(self, rowid: int) -> tuple[int, int] | None:
+        result = self.call('get_subtree_range', rowid)
+        return tuple(result) if result is not None else None
+
+    def is_in_subtree(self, rowid: int, ancestor_rowid: int) -> bool:
+        return self.call('is_in_subtree', rowid, ancestor_rowid)
+
+    def count_subtree(
+        self,
+        path: str,
+        types: Iterable[int] | None = None,
+        uids: Iterable[int] | None = None,
+        selinux_types: Iterable[str] | None = None,
+    ) -> int:
+        return self.call(
+            'count_subtree',
+            path,
+            *(
+                None if values is None else list(values)
+                for values in (types, uids, selinux_types)
+            ),
+        )
+
+    def count_subtree_accesses(self, path: str, case: str | None = None) -> int:
+        return self.call('count_subtree_accesses', path, case)
+
+    def can_read(self, ino: Inode, uid: int) -> bool:
+        return self.call('can_read', ino, uid)
+
+    def can_write(self, ino: Inode, uid: int) -> bool:
+        return self.call('can_write', ino, uid)
+
+    def can_execute(self, ino: Inode, uid: int) -> bool:
+        return self.call('can_execute', ino, uid)
+
+    def has_effective_access(
+        self, rowid: int, uid: int, permission: int
+    ) -> bool | None:
+        return self.call('has_effective_access', rowid, uid, permission)
+
+    def close(self):
+        self._responses.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='path of the database file')
+    parser.add_argument('socket', help='path of the Unix socket')
+    parser.add_argument(
+        '-j',
+        '--workers',
+        type=int,
+        default=4,
+        help='number of read connections (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--pipeline',
+        type=int,
+        default=256,
+        help='''maximum number of requests of a client executed at once
+        (default: %(default)s)''',
+    )
+    parser.add_argument(
+        '--immutable',
+        action='store_true',
+        help='open a published snapshot that is never written without locks',
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        serve(
+            args.database,
+            args.socket,
+            args.workers,
+            args.pipeline,
+            args.immutable,
+        )
+    )
@@ -0,0 +1,126 @@
+#  Copyright (C) 2021-2023 Roderik Ploszek
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Export the fs table to the nested document of `fs2json.walktree`.
+
+Usage: python3 -m fs2json.sql2json <database> [options]
+"""
+import argparse
+from collections.abc import Iterator
+from stat import S_IFDIR
+from .db import DatabaseCommon, DatabaseRead
+from .fs2json import format_json, open_output
+
+# Arguments of `format_json` except mode, followed by type and mode. Times
+# are declared INTEGER, so whole seconds are stored as integers and have to
+# be converted back to print them as `os.stat` floats.
+_COLUMNS = '''name, ino, dev, nlink, uid, gid, size, CAST(atime AS REAL),
+    CAST(mtime AS REAL), CAST(ctime AS REAL), type, mode'''
+
+
+def iter_tree(db: DatabaseCommon, path: str = '/') -> Iterator[tuple | None]:
+    """Walk the subtree at `path` in depth-first order through the parent
+    index.
+
+    Children are listed in the order of rowids, which is the order in which
+    a serial scan found them, so the output matches `fs2json.walktree`. One
+    cursor is kept open for every directory on the current path.
+
+    :returns: Iterator over dentries as tuples of `name`, `ino`, `dev`,
+    `nlink`, `uid`, `gid`, `size`, `atime`, `mtime`, `ctime`, `type` and
+    `mode`. Children of a directory follow it and their end is marked by
+    `None`.
+    """
+    rowid = db.get_rowid(path)
+    if rowid is None:
+        raise FileNotFoundError(path)
+    row = db.con.execute(
+        f'SELECT {_COLUMNS} FROM fs WHERE rowid = ?', (rowid,)
+    ).fetchone()
+    yield row
+    if row[10] != S_IFDIR:
+        return
+    query = f'SELECT rowid, {_COLUMNS} FROM fs WHERE parent = ? ORDER BY rowid'
+    stack = [db.con.execute(query, (rowid,))]
+    while stack:
+        row = next(stack[-1], None)
+        if row is None:
+            stack.pop()
+            yield None
+            continue
+        yield row[1:]
+        if row[11] == S_IFDIR:
+            stack.append(db.con.execute(query, (row[0],)))
+
+
+def export_json(db: DatabaseCommon, out, path: str = '/') -> int:
+    """Write the subtree at `path` to `out` in the format of
+    `fs2json.walktree`.
+
+    :param out: object with a `write` method accepting strings.
+    :returns: number of exported dentries.
+    """
+    count = 0
+    # Whether the next dentry is the first one in its list of children
+    first = True
+    for dentry in iter_tree(db, path):
+        if dentry is None:
+            out.write(']}')
+            first = False
+            continue
+        *data, _type, mode = dentry
+        info = format_json(*data, _type | mode)
+        if not first:
+            out.write(', ')
+        if _type == S_IFDIR:
+            out.write(info[:-1] + ', "children": [')
+            first = True
+        else:
+            out.write(info)
+            first = False
+        count += 1
+    out.write('\n')
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='path of the database file')
+    parser.add_argument(
+        '-p',
+        '--path',
+        default='/',
+        help='export only the subtree at this path (default: %(default)s)',
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='write to this file instead of standard output',
+    )
+    parser.add_argument(
+        '-c',
+        '--compress',
+        choices=('auto', 'zstd', 'gzip', 'xz', 'none'),
+        default='auto',
+        help='''compression of the output, auto chooses it from the suffix of
+        the output file (default: %(default)s)''',
+    )
+    parser.add_argument(
+        '-l', '--level', type=int, help='compression level'
+    )
+    args = parser.parse_args()
+    db = DatabaseRead(args.database)
+    with open_output(args.output, args.compress, args.level) as out:
+        export_json(db, out, args.path)
+    db.close()